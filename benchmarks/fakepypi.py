@@ -0,0 +1,173 @@
+"""
+A local stand-in for pypi.org, serving a synthetic package index:
+
+* /                          the front page, stating the number of projects
+* /simple/                   the listing, as PEP 691 JSON or PEP 503 HTML depending on the Accept header
+* /pypi/<name>/json          the JSON API document of a package
+* /files/<name>/<filename>   the release files, honoring Range requests
+
+Every package is named pkg<number> and has the same shape, so that results only depend on the given counts and sizes.
+All release files share one payload (and digest), which keeps the server itself cheap compared to the client.
+
+Usage: python benchmarks/fakepypi.py --projects 10000 --versions 10 --files 3 --size 65536 --latency 0.01
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# The kinds of files a version has, the first --files of them are used
+FILE_KINDS = (
+	('{name}-{version}.tar.gz', 'sdist', 'source'),
+	('{name}-{version}-py3-none-any.whl', 'bdist_wheel', 'py3'),
+	('{name}-{version}-cp310-cp310-manylinux_2_17_x86_64.whl', 'bdist_wheel', 'cp310'),
+	('{name}-{version}-cp310-cp310-win_amd64.whl', 'bdist_wheel', 'cp310'),
+	('{name}-{version}-cp310-cp310-win32.whl', 'bdist_wheel', 'cp310'),
+	('{name}-{version}-cp310-cp310-macosx_11_0_arm64.whl', 'bdist_wheel', 'cp310'),
+)
+
+class FakeIndex:
+	def __init__(self, projects, versions, files, size, description_size, serial):
+		self.projects = projects
+		self.versions = [f"{number}.0.0" for number in range(1, versions + 1)]
+		self.kinds = FILE_KINDS[:max(1, min(files, len(FILE_KINDS)))]
+		self.payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+		self.digests = {'sha256': hashlib.sha256(self.payload).hexdigest(), 'md5': hashlib.md5(self.payload).hexdigest()}
+		self.description = 'x' * description_size
+		self.serial = serial
+
+		self.json_listing = json.dumps({
+			'meta': {'api-version': '1.0', '_last-serial': serial},
+			'projects': [{'name': f"pkg{index}", '_last-serial': serial - index % 1000} for index in range(projects)]
+		}).encode('UTF-8')
+		self.html_listing = b''.join([
+			b'<!DOCTYPE html>\n<html>\n  <head>\n    <title>Simple index</title>\n  </head>\n  <body>\n',
+			*(f'    <a href="/simple/pkg{index}/">pkg{index}</a>\n'.encode('UTF-8') for index in range(projects)),
+			b'  </body>\n</html>',
+		])
+
+	def document(self, name, host):
+		releases = {}
+		for version in self.versions:
+			releases[version] = []
+			for pattern, packagetype, python_version in self.kinds:
+				filename = pattern.format(name=name, version=version)
+				releases[version].append({
+					'filename': filename,
+					'url': f"http://{host}/files/{name}/{filename}",
+					'digests': self.digests,
+					'packagetype': packagetype,
+					'python_version': python_version,
+					'requires_python': '>=3.7',
+					'size': len(self.payload),
+					'yanked': False,
+				})
+
+		return {
+			'info': {
+				'name': name,
+				'version': self.versions[-1],
+				'summary': f"The {name} benchmark package",
+				'description': self.description,
+				'requires_python': '>=3.7',
+				'license': 'MIT',
+				'classifiers': ['License :: OSI Approved :: MIT License', 'Programming Language :: Python :: 3'],
+			},
+			'last_serial': self.serial,
+			'releases': releases,
+			'urls': releases[self.versions[-1]],
+		}
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def respond(self, status, body=b'', content_type='text/html', headers=None):
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		index = self.server.index
+		if self.server.latency:
+			time.sleep(self.server.latency)
+
+		path = self.path.split('?', 1)[0]
+		if path == '/':
+			return self.respond(200, f"<p>{index.projects:,} projects</p>".encode('UTF-8'))
+
+		if path == '/simple/':
+			etag = f'"{index.serial}"'
+			if self.headers.get('If-None-Match', None) == etag:
+				return self.respond(304, headers={'ETag': etag})
+
+			if 'application/vnd.pypi.simple.v1+json' in self.headers.get('Accept', ''):
+				return self.respond(200, index.json_listing, 'application/vnd.pypi.simple.v1+json', {'ETag': etag, 'X-PyPI-Last-Serial': str(index.serial)})
+
+			return self.respond(200, index.html_listing, headers={'ETag': etag})
+
+		parts = path.strip('/').split('/')
+		if len(parts) == 3 and parts[0] == 'pypi' and parts[2] == 'json':
+			document = json.dumps(index.document(parts[1], self.headers.get('Host', ''))).encode('UTF-8')
+			return self.respond(200, document, 'application/json', {'ETag': f'"{parts[1]}-{index.serial}"'})
+
+		if len(parts) == 3 and parts[0] == 'files':
+			start = 0
+			if (requested := self.headers.get('Range', None)) and requested.startswith('bytes='):
+				start = int(requested[6:].split('-', 1)[0] or 0)
+
+			if start:
+				return self.respond(206, index.payload[start:], 'application/octet-stream', {'Content-Range': f"bytes {start}-{len(index.payload) - 1}/{len(index.payload)}"})
+
+			return self.respond(200, index.payload, 'application/octet-stream')
+
+		self.respond(404, b'Not Found')
+
+def serve(port=0, latency=0.0, **index_arguments) -> ThreadingHTTPServer:
+	server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+	server.daemon_threads = True
+	server.index = FakeIndex(**index_arguments)
+	server.latency = latency
+
+	return server
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Serves a synthetic PyPI index for benchmarking")
+	parser.add_argument("--port", default=0, type=int, help="Which port to listen on, 0 picks a free one")
+	parser.add_argument("--projects", default=10000, type=int, help="How many projects the listing contains")
+	parser.add_argument("--versions", default=10, type=int, help="How many versions each project has")
+	parser.add_argument("--files", default=3, type=int, help="How many files each version has (at most 6)")
+	parser.add_argument("--size", default=64 * 1024, type=int, help="How many bytes each file is")
+	parser.add_argument("--description-size", default=4000, type=int, help="How long the description in each JSON document is")
+	parser.add_argument("--latency", default=0.0, type=float, help="How many seconds to wait before answering each request")
+	parser.add_argument("--serial", default=1000000, type=int, help="The serial of the listing")
+	arguments = parser.parse_args()
+
+	server = serve(
+		port=arguments.port,
+		latency=arguments.latency,
+		projects=arguments.projects,
+		versions=arguments.versions,
+		files=arguments.files,
+		size=arguments.size,
+		description_size=arguments.description_size,
+		serial=arguments.serial,
+	)
+
+	# The benchmark runner reads the port from this line
+	print(f"Listening on {server.server_address[0]}:{server.server_address[1]}", flush=True)
+
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		sys.exit(0)
@@ -0,0 +1,201 @@
+"""
+Runs the pypiapi benchmarks against a local fake PyPI server (see fakepypi.py).
+
+Every scenario runs in a process of its own, against an empty destination, so that
+caches and memory from one scenario don't affect the next and peak RSS can be measured:
+
+* listing-json      iterating PackageListing over the PEP 691 JSON listing
+* listing-html      iterating PackageListing over the PEP 503 HTML listing
+* metadata          fetching and storing the JSON API documents of --packages packages
+* versions          Package.versions() of --packages packages, with their information already loaded
+* download          Package.download() of every retained version of --download-packages packages, one file at a time
+* download-paralell the same files through the DownloadScheduler (--paralell-downloads)
+
+Usage: python benchmarks/run.py --projects 100000 --packages 500 --latency 0.005 --output bench.jsonl
+"""
+import argparse
+import json
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent
+SCENARIOS = ('listing-json', 'listing-html', 'metadata', 'versions', 'download', 'download-paralell')
+
+def peak_rss() -> int:
+	"""
+	Returns the peak resident memory of this process in bytes.
+	"""
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports KiB, macOS bytes
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+def human_bytes(num :float) -> str:
+	for unit in ('B', 'KiB', 'MiB', 'GiB'):
+		if abs(num) < 1024:
+			return f"{num:.1f} {unit}"
+		num /= 1024
+
+	return f"{num:.1f} TiB"
+
+def load_information(pypiapi, count):
+	packages = [pypiapi.Package(f"pkg{index}") for index in range(count)]
+	return list(pypiapi.metadata_cache().prefetch(packages))
+
+def measure(scenario, arguments):
+	"""
+	Runs a single scenario inside this process and returns its result.
+	"""
+	import pypiapi
+
+	pypiapi.configure([
+		'--mirror', '127.0.0.1',
+		'--port', str(arguments.port),
+		'--no-tls',
+		'--destination', str(arguments.destination),
+		'--listing-format', 'html' if scenario == 'listing-html' else 'json',
+		'--metadata-workers', str(arguments.metadata_workers),
+		'--paralell-downloads', str(arguments.paralell_downloads),
+		'--retain-versions', str(arguments.retain_versions),
+		'--verbosity-level', 'error',
+	])
+
+	baseline = peak_rss()
+	transferred = 0
+
+	if scenario in ('listing-json', 'listing-html'):
+		started = time.perf_counter()
+		items = sum(1 for _ in pypiapi.PackageListing())
+		unit = 'projects'
+
+	elif scenario == 'metadata':
+		started = time.perf_counter()
+		items = len(load_information(pypiapi, arguments.packages))
+		unit = 'packages'
+
+	elif scenario == 'versions':
+		packages = load_information(pypiapi, arguments.packages)
+		started = time.perf_counter()
+		items = sum(len(package.versions()) for package in packages)
+		unit = 'versions'
+
+	else:
+		packages = load_information(pypiapi, arguments.download_packages)
+		selection = {package: package.versions() for package in packages}
+
+		started = time.perf_counter()
+		if scenario == 'download':
+			for package, versions in selection.items():
+				for version in versions:
+					package.download(version)
+		else:
+			with pypiapi.DownloadScheduler() as scheduler:
+				futures = [future for package, versions in selection.items() for version in versions for future in scheduler.submit(package, version)]
+				for future in futures:
+					future.result()
+
+		files = [path for path in arguments.destination.glob('*/*') if path.is_file()]
+		transferred = sum(path.stat().st_size for path in files)
+		items = len(files)
+		unit = 'files'
+
+	elapsed = time.perf_counter() - started
+
+	return {
+		'scenario': scenario,
+		'items': items,
+		'unit': unit,
+		'seconds': elapsed,
+		'rate': items / elapsed if elapsed else 0,
+		'bytes_per_second': transferred / elapsed if elapsed else 0,
+		'baseline_rss': baseline,
+		'peak_rss': peak_rss(),
+	}
+
+def run(scenario, port, arguments) -> dict:
+	with tempfile.TemporaryDirectory(prefix='pypiapi-bench-') as destination:
+		command = [
+			sys.executable, __file__, '--measure', scenario,
+			'--port', str(port),
+			'--destination', destination,
+			'--packages', str(arguments.packages),
+			'--download-packages', str(arguments.download_packages),
+			'--retain-versions', str(arguments.retain_versions),
+			'--metadata-workers', str(arguments.metadata_workers),
+			'--paralell-downloads', str(arguments.paralell_downloads),
+		]
+
+		# Make the checkout importable without installing it
+		environment = {**os.environ, 'PYTHONPATH': str(ROOT.parent)}
+		result = subprocess.run(command, capture_output=True, text=True, env=environment)
+		if result.returncode != 0:
+			raise RuntimeError(f"Scenario {scenario} failed:\n{result.stderr}")
+
+		return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmarks pypiapi against a local fake PyPI server")
+	parser.add_argument("--scenarios", default=','.join(SCENARIOS), type=str, help=f"Which scenarios to run, comma separated: {', '.join(SCENARIOS)}")
+	parser.add_argument("--projects", default=100000, type=int, help="How many projects the listing contains")
+	parser.add_argument("--versions", default=20, type=int, help="How many versions each project has")
+	parser.add_argument("--files", default=3, type=int, help="How many files each version has (at most 6)")
+	parser.add_argument("--size", default=256 * 1024, type=int, help="How many bytes each file is")
+	parser.add_argument("--description-size", default=4000, type=int, help="How long the description in each JSON document is")
+	parser.add_argument("--latency", default=0.0, type=float, help="How many seconds the server waits before answering each request")
+	parser.add_argument("--packages", default=500, type=int, help="How many packages the metadata and versions scenarios use")
+	parser.add_argument("--download-packages", default=20, type=int, help="How many packages the download scenarios use")
+	parser.add_argument("--retain-versions", default=3, type=int, help="How many versions per package are downloaded")
+	parser.add_argument("--metadata-workers", default=8, type=int, help="Passed on to pypiapi")
+	parser.add_argument("--paralell-downloads", default=4, type=int, help="Passed on to pypiapi")
+	parser.add_argument("--repeat", default=1, type=int, help="How many times to run each scenario")
+	parser.add_argument("--output", default=None, type=pathlib.Path, help="Append the results as JSON lines to this file")
+	parser.add_argument("--measure", default=None, type=str, help=argparse.SUPPRESS)
+	parser.add_argument("--port", default=None, type=int, help=argparse.SUPPRESS)
+	parser.add_argument("--destination", default=None, type=pathlib.Path, help=argparse.SUPPRESS)
+	arguments = parser.parse_args()
+
+	if arguments.measure:
+		print(json.dumps(measure(arguments.measure, arguments)))
+		return
+
+	scenarios = [scenario for scenario in arguments.scenarios.split(',') if scenario]
+	if unknown := set(scenarios) - set(SCENARIOS):
+		parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+	server = subprocess.Popen([
+		sys.executable, str(ROOT/'fakepypi.py'),
+		'--projects', str(arguments.projects),
+		'--versions', str(arguments.versions),
+		'--files', str(arguments.files),
+		'--size', str(arguments.size),
+		'--description-size', str(arguments.description_size),
+		'--latency', str(arguments.latency),
+	], stdout=subprocess.PIPE, text=True)
+
+	try:
+		port = int(server.stdout.readline().strip().rsplit(':', 1)[1])
+
+		print(f"{'scenario':<18} {'items':>9} {'seconds':>9} {'rate':>18} {'throughput':>13} {'baseline rss':>13} {'peak rss':>11}")
+		for scenario in scenarios:
+			for _ in range(arguments.repeat):
+				result = run(scenario, port, arguments)
+				result['config'] = {key: getattr(arguments, key) for key in ('projects', 'versions', 'files', 'size', 'latency', 'packages', 'download_packages', 'retain_versions', 'metadata_workers', 'paralell_downloads')}
+				result['timestamp'] = time.time()
+
+				throughput = f"{human_bytes(result['bytes_per_second'])}/s" if result['bytes_per_second'] else '-'
+				print(f"{scenario:<18} {result['items']:>9} {result['seconds']:>9.3f} {result['rate']:>9.1f} {result['unit'] + '/s':<8} {throughput:>13} {human_bytes(result['baseline_rss']):>13} {human_bytes(result['peak_rss']):>11}", flush=True)
+
+				if arguments.output:
+					with open(arguments.output, 'a') as fh:
+						fh.write(json.dumps(result) + '\n')
+	finally:
+		server.terminate()
+		server.wait()
+
+
+if __name__ == '__main__':
+	main()
@@ -1,54 +1,44 @@
-import sys
-import pathlib
-import argparse
-import logging
+import importlib
+
 from .storage import *
+from .config import parser, configure
+from .exceptions import *
+from .logger import log
+# Imported up front, as importing the pypiapi.metrics module would otherwise shadow metrics()
+from .metrics import Metrics, metrics
+from .sockethelpers import *
 
 __version__ = '0.0.1.dev2'
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--mirror", default='pypi.org', type=str, nargs='?', help="Which upstream host contains the pypi API")
-parser.add_argument("--port", default=443, type=int, nargs='?', help="Which port to connect to against the --mirror")
-parser.add_argument("--tls", default=True, action="store_true", help="Enable TLS functionality against the API")
-parser.add_argument("--simple-api", default='/simple', type=str, nargs='?', help="Which endpoint contains the simple API")
-parser.add_argument("--json-api", default='/pypi', type=str, nargs='?', help="Which endpoint contains the JSON API")
-parser.add_argument("--retain-versions", default=3, type=int, nargs='?', help="What is the global retension of versions per package")
-parser.add_argument("--sort-algorithm", default='SpecifierSet', type=str, nargs='?', help="Which version sort algorithm should be applied on --retain-versions")
-parser.add_argument("--destination", default='./cache', type=pathlib.Path, nargs='?', help="Where should we place the package results")
-parser.add_argument("--timeout", default=5, type=int, nargs='?', help="What global timeout should we have on trying to retrieve listings and packages")
-parser.add_argument("--cache-listing", action="store_true", default=True, help="")
-parser.add_argument("--py-version", default='3.10', type=str, nargs='?', help="Which python version do we support (default to the highest possible)")
-parser.add_argument("--licenses", default='', type=str, nargs='?', help="Which licenses should we filter on, detaul any. Example: --licenses 'MIT,GPLv3'")
-parser.add_argument("--architectures", default='x86_64,win_amd64,any', type=str, nargs='?', help="Which architectures (x86_64, i686, win32, win_amd64, etc) should we filter on, detaul any. Example: --licenses 'MIT,GPLv3'")
-parser.add_argument("--verbosity-level", default='info', type=str, nargs='?', help="Sets the lowest threashold for log messages, according to https://docs.python.org/3/library/logging.html#logging-levels")
-parser.add_argument("--paralell-downloads", default=2, type=int, nargs='?', help="Define how many paralell downloads can simulatniously be allowed to run.")
-parser.add_argument("--proxy-protocol", default="https", type=str, nargs='?', help="If a --proxy-host is set, which protocol should we use?.")
-parser.add_argument("--proxy-host", default=None, type=str, nargs='?', help="Define a proxy to use (ip or hostname).")
-parser.add_argument("--proxy-port", default=8080, type=int, nargs='?', help="Define a port to connect to the proxy.")
-parser.add_argument("--skip-unknown-py-versions", default=False, action="store_true", help="Enables skipping of packages that haven't defined a PyVersion >X.Y definition.")
-
-storage['arguments'], unknowns = parser.parse_known_args()
 storage['version'] = __version__
 
-storage['arguments'].destination = storage['arguments'].destination.resolve()
-storage['arguments'].licenses = [license for license in storage['arguments'].licenses.split(',') if license]
-storage['arguments'].architectures = [arch for arch in storage['arguments'].architectures.split(',') if arch]
+# Everything else is imported the first time it's used (ex. pypiapi.PackageListing),
+# which keeps `import pypiapi` cheap for short-lived tools and workers.
+_lazy = {
+	'.packages': ['Package', 'select_versions', 'safe_version', 'compile_python_requirement', 'CHUNK_SIZE'],
+	'.listing': ['PackageListing'],
+	'.downloader': ['DownloadScheduler', 'human_bytes'],
+	'.artifacts': ['ArtifactIndex', 'artifact_index', 'hash_file'],
+	'.blobs': ['BlobStore', 'blob_store'],
+	'.metadata': ['MetadataCache', 'MetadataStore', 'metadata_cache', 'metadata_store'],
+	'.connections': ['ConnectionPool', 'connection_pool', 'mirror_url'],
+	'.journal': ['SyncJournal'],
+	'.filters': ['FilterPipeline', 'filter_pipeline', 'supports_python', 'in_shard', 'shard_suffix'],
+	'.licenses': ['licence_classifier_parser'],
+	'.retention': ['GarbageCollector'],
+	'.verification': ['Verifier'],
+	'.simpleindex': ['SimpleIndex', 'simple_index', 'serve'],
+	'.scheduler': ['RequestScheduler', 'request_scheduler'],
+}
+_lazy_names = {name: module for module, names in _lazy.items() for name in names}
+
+def __getattr__(name):
+	if (module := _lazy_names.get(name, None)) is None:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-match storage['arguments'].verbosity_level.lower():
-	case 'critical':
-		storage['arguments'].verbosity_level = logging.CRITICAL
-	case 'error':
-		storage['arguments'].verbosity_level = logging.ERROR
-	case 'warning':
-		storage['arguments'].verbosity_level = logging.WARNING
-	case 'info':
-		storage['arguments'].verbosity_level = logging.INFO
-	case 'debug':
-		storage['arguments'].verbosity_level = logging.DEBUG
-	case 'noset':
-		storage['arguments'].verbosity_level = logging.NOSET
-	
+	value = getattr(importlib.import_module(module, __name__), name)
+	globals()[name] = value
+	return value
 
-from .packages import *
-from .listing import PackageListing
-from .sockethelpers import *
\ No newline at end of file
+def __dir__():
+	return sorted([*globals(), *_lazy_names])
@@ -1,68 +1,241 @@
-import json
 import logging
 import pypiapi
 import asyncio
-
-packages = {}
-
-async def get_packages(main_loop):
-	for index, package in enumerate(pypiapi.PackageListing()):
-		packages[package] = False
-
-		if main_loop.is_running() is False:
+import http.client
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# The sync is split up in stages, each with its own workers, connected by bounded queues:
+#
+#   list -> fetch information -> select versions and files -> download
+#
+# A full queue makes the stage before it wait, so memory stays flat no matter
+# how long the listing is, and idle workers simply sleep on their queue.
+DONE = None
+
+def list_packages(loop, listing, journal, queue, stopping):
+	"""
+	Runs the (blocking) listing on its own thread, feeding packages to the event loop.
+	"""
+	index = 0
+	try:
+		for package in listing:
+			if stopping.is_set():
+				break
+
+			# Packages completed by an interrupted run are skipped before fetching anything
+			if journal.completed(package.name):
+				continue
+
+			index += 1
+			asyncio.run_coroutine_threadsafe(queue.put(package), loop).result()
+	finally:
+		pypiapi.log(f"Done listing all {index} packages", level=logging.INFO, fg="green")
+
+async def fetch_information(executor, packages, selections, unfinished):
+	loop = asyncio.get_running_loop()
+
+	while (package := await packages.get()) is not DONE:
+		try:
+			await loop.run_in_executor(executor, package.load_information)
+		except pypiapi.InvalidPackage as err:
+			pypiapi.log(f"Skipping package {package} due to: {err}", level=logging.WARNING, fg="orange")
+			unfinished.add(package.name)
+			continue
+		except (OSError, http.client.HTTPException) as err:
+			# Still failing after --max-retries, the package is left out of the journal so a resumed run tries it again
+			pypiapi.log(f"Skipping package {package}, its information could not be fetched: {err!r}", level=logging.ERROR, fg="red")
+			unfinished.add(package.name)
+			continue
+
+		await selections.put(package)
+
+def select_files(package):
+	selected = []
+	changed = False
+	versions = package.versions()
+	for version in versions:
+		try:
+			files, linked = package.prepare(version)
+		except (pypiapi.DependencyError, pypiapi.VersionError) as err:
+			pypiapi.log(f"Skipping package {package} due to: {err}", level=logging.WARNING, fg="orange")
 			break
 
-		await asyncio.sleep(0)
-
-	pypiapi.log(f"Done listing all {index} packages", level=logging.INFO, fg="green")
-
-async def download(listing_loop):
-	while listing_loop.done() is False or len(list(packages.keys())) > 0:
-		if pypiapi.storage['arguments'].retain_versions:
-			for package in list(packages.keys()):
-				if packages[package] is False:
-					try:
-						package.load_information()
-					except pypiapi.InvalidPackage as err:
-						pypiapi.log(f"Skipping package {package} due to: {err}", level=logging.WARNING, fg="orange")
-
-						del(packages[package])
-						continue
-
-					packages[package] = True
-
-				for index, version in enumerate(package.versions()):
-					try:
-						package.download(version)
-					except pypiapi.DependencyError as err:
-						pypiapi.log(f"Skipping package {package} due to: {err}", level=logging.WARNING, fg="orange")
-						break
-					except pypiapi.VersionError as err:
-						pypiapi.log(f"Skipping package {package} due to: {err}", level=logging.WARNING, fg="orange")
-						break
-
-					if index == pypiapi.storage['arguments'].retain_versions - 1:
-						break
-
-					await asyncio.sleep(0)
-
-				# Once we're on the final version, remove the package
-				# To avoid iterating the package once more.
-				# (Since download() is run until the listing is done)
-				del(packages[package])
-
-				await asyncio.sleep(0)
-
-		# else:
-		# 	for package in list(packages.keys()):
-		# 		for version in package.versions():
-		# 			package.download(version)
-
-		await asyncio.sleep(0)
+		changed = changed or linked
+		if files:
+			pypiapi.log(f"Initating download of {package}@version: {version}", fg="yellow", level=logging.INFO)
+			selected += files
+
+	# Only the selected releases are needed from here on (downloads and the simple index),
+	# the rest would otherwise sit in memory while the package waits for its downloads
+	package.retain(versions)
+
+	# Files linked from the blob store never reach the download stage, which rewrites the page otherwise.
+	# Packages that are already complete only need a page if they don't have one yet.
+	if pypiapi.storage['arguments'].simple_index and (changed or (not selected and not pypiapi.simple_index().exists(package))):
+		pypiapi.simple_index().update(package)
+
+	return selected
+
+async def select_versions(executor, selections, downloads, journal):
+	loop = asyncio.get_running_loop()
+
+	while (package := await selections.get()) is not DONE:
+		# Picking files includes checking the ones already on disk, so it's done on a thread
+		if files := await loop.run_in_executor(executor, select_files, package):
+			await downloads.put((package, files))
+		else:
+			journal.record(package.name)
+
+async def download(scheduler, downloads, journal, unfinished):
+	loop = asyncio.get_running_loop()
+
+	while (item := await downloads.get()) is not DONE:
+		package, files = item
+
+		completed = True
+		downloaded = False
+		for file in files:
+			if await loop.run_in_executor(scheduler.executor, scheduler.transfer, package, file) is None:
+				completed = False
+			else:
+				downloaded = True
+
+		if downloaded and pypiapi.storage['arguments'].simple_index:
+			await loop.run_in_executor(None, pypiapi.simple_index().update, package)
+
+		# The package is recorded in the journal once all its files are on disk,
+		# so that a restarted run doesn't have to look at it again.
+		if completed:
+			journal.record(package.name)
+		else:
+			unfinished.add(package.name)
+
+async def stage(workers, next_queue, next_workers):
+	"""
+	Waits for all workers of a stage, then tells the next stage's workers that nothing more is coming.
+	"""
+	await asyncio.gather(*workers)
+
+	for _ in range(next_workers):
+		await next_queue.put(DONE)
+
+async def sync(listing, journal, scheduler):
+	"""
+	Runs the stages of a sync, returning the names of the packages that could not be finished.
+	"""
+	arguments = pypiapi.storage['arguments']
+	unfinished = set()
+	loop = asyncio.get_running_loop()
+
+	packages = asyncio.Queue(arguments.queue_size)
+	selections = asyncio.Queue(arguments.queue_size)
+	downloads = asyncio.Queue(arguments.queue_size)
+
+	stopping = threading.Event()
+	listing_thread = loop.run_in_executor(None, list_packages, loop, listing, journal, packages, stopping)
+
+	with ThreadPoolExecutor(arguments.metadata_workers, thread_name_prefix='pypiapi-metadata') as metadata_executor, \
+		ThreadPoolExecutor(arguments.select_workers, thread_name_prefix='pypiapi-select') as select_executor:
+
+		try:
+			await asyncio.gather(
+				stage([listing_thread], packages, arguments.metadata_workers),
+				stage([fetch_information(metadata_executor, packages, selections, unfinished) for _ in range(arguments.metadata_workers)], selections, arguments.select_workers),
+				stage([select_versions(select_executor, selections, downloads, journal) for _ in range(arguments.select_workers)], downloads, scheduler.workers),
+				stage([download(scheduler, downloads, journal, unfinished) for _ in range(scheduler.workers)], downloads, 0),
+			)
+		finally:
+			stopping.set()
+
+	return unfinished
+
+def launch(workers):
+	"""
+	Splits the sync over `workers` processes, each running this module on a shard of its own.
+	If this process was itself given a --shard K/N, it's split further into shards
+	K, K+N, K+2N.. of N*workers, which together cover exactly the packages of shard K/N.
+	Returns the highest exit code of the processes.
+	"""
+	index, count = pypiapi.storage['arguments'].shard or (1, 1)
+
+	processes = []
+	for worker in range(workers):
+		shard = f"{index + count * worker}/{count * workers}"
+		# Later arguments take precedence, so the parent's --workers and --shard are simply overridden
+		processes.append(subprocess.Popen([sys.executable, '-m', 'pypiapi', *sys.argv[1:], '--workers', '1', '--shard', shard]))
+
+	pypiapi.log(f"Started {workers} processes, each syncing a shard of {count * workers}", level=logging.INFO, fg="green")
+
+	try:
+		return max(process.wait() for process in processes)
+	except KeyboardInterrupt:
+		# The processes got the same interrupt, give them the chance to finish writing their journal
+		for process in processes:
+			process.wait()
+		raise
+
+
+def run_sync():
+	if pypiapi.storage['arguments'].workers > 1:
+		sys.exit(launch(pypiapi.storage['arguments'].workers))
+
+	if pypiapi.storage['arguments'].verify_deep and pypiapi.storage['arguments'].destination.is_dir():
+		# Corrupt files are dropped from the artifact index, so the sync below downloads them again
+		pypiapi.Verifier().run()
+
+	journal = pypiapi.SyncJournal()
+	if len(journal):
+		pypiapi.log(f"Resuming an interrupted sync, skipping {len(journal)} already completed packages", level=logging.INFO, fg="yellow")
+
+	if pypiapi.storage['arguments'].metrics_file:
+		pypiapi.metrics().start()
+
+	package_listing = pypiapi.PackageListing()
+	try:
+		with pypiapi.DownloadScheduler() as scheduler:
+			unfinished = asyncio.run(sync(package_listing, journal, scheduler))
+	finally:
+		if pypiapi.storage['arguments'].metrics_file:
+			pypiapi.metrics().stop()
+
+	if unfinished:
+		pypiapi.log(f"{len(unfinished)} packages could not be finished, the next --incremental run processes them again", level=logging.WARNING, fg="orange")
+
+	package_listing.commit_serial(unfinished)
+	journal.clear()
+
+	if pypiapi.storage['arguments'].simple_index:
+		pypiapi.simple_index().commit()
+
+	if pypiapi.storage['arguments'].gc:
+		pypiapi.GarbageCollector().run()
+
+def run_gc():
+	pypiapi.GarbageCollector().run()
+
+	if pypiapi.storage['arguments'].simple_index:
+		pypiapi.simple_index().commit()
+
+def run_serve():
+	pypiapi.serve()
+
+def run_verify():
+	if not pypiapi.Verifier().run(report=pypiapi.storage['arguments'].report):
+		sys.exit(1)
+
+
+COMMANDS = {
+	'sync': run_sync,
+	'gc': run_gc,
+	'serve': run_serve,
+	'verify': run_verify,
+}
 
 if __name__ == '__main__':
-	loop = asyncio.get_event_loop()
-	listing = loop.create_task(get_packages(loop))
-	loop.run_until_complete(download(listing))
-	# loop = asyncio.get_event_loop()
-	# loop.run_until_complete(get_packages(loop))
+	if pypiapi.storage['arguments'].command not in COMMANDS:
+		pypiapi.parser.error(f"Unknown command {pypiapi.storage['arguments'].command}, expected one of: {', '.join(COMMANDS)}")
+
+	COMMANDS[pypiapi.storage['arguments'].command]()
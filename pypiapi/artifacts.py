@@ -0,0 +1,179 @@
+import hashlib
+import os
+import pathlib
+import threading
+from typing import Dict, Optional, Tuple
+
+from .storage import storage
+from .filters import shard_suffix
+from .metrics import metrics
+
+def hash_file(path, algorithm='sha256', chunk_size=1024 * 1024) -> str:
+	"""
+	Hashes a file in chunks, so that large files don't have to be read into memory.
+	"""
+	checksum = hashlib.new(algorithm)
+	with metrics().histogram('pypiapi_hash_seconds', "Seconds spent hashing files already on disk").time(), open(path, 'rb') as fh:
+		while chunk := fh.read(chunk_size):
+			checksum.update(chunk)
+
+	return checksum.hexdigest()
+
+class ArtifactIndex:
+	"""
+	A persistent, append-only record of files that have been verified against their digest.
+	Each line is "<algorithm>:<digest>\\t<size>\\t<mtime_ns>\\t<relative path>", and the last
+	line for a path wins. As long as size and mtime are unchanged, a file is considered
+	verified without having to read it again.
+	When running as a --shard, new lines go to a file of its own (<filename>.shard-K-of-N)
+	so that shards don't write to the same file, and the next unsharded run merges them back.
+	"""
+	def __init__(self, destination=None, filename='.artifacts'):
+		if not destination:
+			destination = storage['arguments'].destination
+
+		self.root = pathlib.Path(destination)
+		self.filename = filename
+		self.path = self.root/f"{filename}{shard_suffix()}"
+		self.sharded = self.path.name != filename
+		self.lock = threading.Lock()
+		self.entries: Dict[str, Tuple[str, int, int]] = {}
+		self.fh = None
+
+		self.load()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def shard_files(self):
+		return sorted(path for path in self.root.glob(f"{self.filename}.shard-*") if path.suffix != '.tmp')
+
+	def load(self):
+		# Shards only ever write the packages of their own shard, so the order between their files doesn't matter
+		paths = [path for path in [self.root/self.filename, *self.shard_files()] if path.exists()]
+
+		lines = 0
+		for path in paths:
+			with open(path, 'r') as fh:
+				for line in fh:
+					try:
+						digest, size, mtime, relative = line.rstrip('\n').split('\t', 3)
+						size, mtime = int(size), int(mtime)
+					except ValueError:
+						# A partially written line from an interrupted run
+						continue
+
+					lines += 1
+					if digest == '-':
+						self.entries.pop(relative, None)
+					else:
+						self.entries[relative] = (digest, size, mtime)
+
+		# Other shards may still be appending to their files, so only an unsharded run compacts
+		if not self.sharded and (len(paths) > 1 or lines > len(self.entries) * 2 + 1000):
+			self.compact()
+
+	def compact(self):
+		"""
+		Rewrites the index with only the current entries, merging in the files of any shards.
+		"""
+		with self.lock:
+			if self.fh:
+				self.fh.close()
+				self.fh = None
+
+			temporary = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+			with open(temporary, 'w') as fh:
+				for relative, (digest, size, mtime) in self.entries.items():
+					fh.write(f"{digest}\t{size}\t{mtime}\t{relative}\n")
+
+			os.replace(temporary, self.path)
+
+			if not self.sharded:
+				for path in self.shard_files():
+					os.unlink(path)
+
+	def _append(self, line :str):
+		if self.fh is None:
+			self.root.mkdir(parents=True, exist_ok=True)
+			self.fh = open(self.path, 'a')
+
+		self.fh.write(line)
+		self.fh.flush()
+
+	def _relative(self, path) -> str:
+		return str(pathlib.Path(path).relative_to(self.root))
+
+	def verified(self, path, digests :dict) -> bool:
+		"""
+		Returns True if the file was previously verified against one of the given digests,
+		and it has not changed size or modification time since. This costs a single stat().
+		"""
+		if not (entry := self.entries.get(self._relative(path))):
+			return False
+
+		algorithm, _, digest = entry[0].partition(':')
+		if digests.get(algorithm, None) != digest:
+			return False
+
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			return False
+
+		return (stat.st_size, stat.st_mtime_ns) == entry[1:]
+
+	def add(self, path, digest :str, algorithm='sha256'):
+		stat = os.stat(path)
+		relative = self._relative(path)
+
+		with self.lock:
+			self.entries[relative] = (f"{algorithm}:{digest}", stat.st_size, stat.st_mtime_ns)
+			self._append(f"{algorithm}:{digest}\t{stat.st_size}\t{stat.st_mtime_ns}\t{relative}\n")
+
+	def remove(self, path):
+		relative = self._relative(path)
+
+		with self.lock:
+			if self.entries.pop(relative, None):
+				self._append(f"-\t0\t0\t{relative}\n")
+
+	def check(self, path, digests :dict) -> Optional[str]:
+		"""
+		Hashes a file on disk and compares it to the given digests (sha256 preferred, md5 as fallback).
+		Matching files are added to the index and the matching algorithm is returned.
+		"""
+		for algorithm in ('sha256', 'md5'):
+			if not (expected := digests.get(algorithm, None)):
+				continue
+
+			if hash_file(path, algorithm) == expected:
+				self.add(path, expected, algorithm)
+				return algorithm
+
+			# Only fall back to md5 if there is no sha256 to compare against
+			break
+
+		return None
+
+	def close(self):
+		with self.lock:
+			if self.fh:
+				self.fh.close()
+				self.fh = None
+
+
+_indexes_lock = threading.Lock()
+
+def artifact_index(destination=None) -> ArtifactIndex:
+	"""
+	Returns the shared ArtifactIndex for a destination, creating it on first use.
+	"""
+	destination = pathlib.Path(destination or storage['arguments'].destination)
+
+	with _indexes_lock:
+		indexes = storage.setdefault('artifact_indexes', {})
+		if destination not in indexes:
+			indexes[destination] = ArtifactIndex(destination)
+
+		return indexes[destination]
@@ -0,0 +1,115 @@
+import errno
+import logging
+import os
+import pathlib
+import threading
+
+from .storage import storage
+from .logger import log
+
+class BlobStore:
+	"""
+	A content-addressed store of release files under <destination>/.blobs/sha256/<ab>/<cd>/<digest>.
+	Each file is stored once no matter how many packages ship it, and <destination>/<name>/<filename>
+	is a hardlink to its blob (or a relative symlink, where hardlinks aren't possible).
+	"""
+	def __init__(self, destination=None):
+		if not destination:
+			destination = storage['arguments'].destination
+
+		self.root = pathlib.Path(destination)/'.blobs'/'sha256'
+		self.hardlinks = True
+
+	def path(self, digest :str) -> pathlib.Path:
+		return self.root/digest[:2]/digest[2:4]/digest
+
+	def exists(self, digest :str) -> bool:
+		return os.path.exists(self.path(digest))
+
+	def add(self, source, digest :str) -> pathlib.Path:
+		"""
+		Moves a freshly verified file into the store. If the blob already exists the file is dropped instead,
+		replacing the blob would leave every existing link to it with a copy of its own.
+		"""
+		blob = self.path(digest)
+		blob.parent.mkdir(parents=True, exist_ok=True)
+
+		try:
+			os.link(source, blob)
+		except FileExistsError:
+			pass
+		except OSError:
+			# Can't hardlink (ex. another filesystem), moving it is fine as long as nothing links to the blob yet
+			if not blob.exists():
+				os.replace(source, blob)
+				return blob
+
+		os.unlink(source)
+		return blob
+
+	def link(self, digest :str, target):
+		"""
+		Points target at the blob of digest, replacing whatever target was.
+		"""
+		blob = self.path(digest)
+		target = pathlib.Path(target)
+		temporary = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.link")
+
+		if self.hardlinks:
+			try:
+				os.link(blob, temporary)
+			except OSError as err:
+				if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+					raise
+
+				log(f"Could not hardlink into {self.root} ({err.strerror}), using symlinks instead", level=logging.WARNING, fg="orange")
+				self.hardlinks = False
+
+		if not self.hardlinks:
+			os.symlink(os.path.relpath(blob, target.parent), temporary)
+
+		# The rename is atomic, so target is never missing while it's being replaced
+		os.replace(temporary, target)
+
+	def adopt(self, path, digest :str) -> bool:
+		"""
+		Brings a verified file that isn't linked to the store yet into it: either by making it the blob,
+		or, if there already is one, by replacing the file with a link to it. Returns True if anything changed.
+		"""
+		blob = self.path(digest)
+		if os.path.islink(path) or (blob.exists() and os.path.samefile(path, blob)):
+			# Already a view of the store
+			return False
+
+		if blob.exists():
+			self.link(digest, path)
+			return True
+
+		blob.parent.mkdir(parents=True, exist_ok=True)
+		try:
+			os.link(path, blob)
+		except FileExistsError:
+			# Another worker stored the same content in the meantime
+			self.link(digest, path)
+		except OSError:
+			# Can't hardlink (ex. another filesystem), keep the file as the blob and link to it instead
+			os.replace(path, blob)
+			self.link(digest, path)
+
+		return True
+
+
+_stores_lock = threading.Lock()
+
+def blob_store(destination=None) -> BlobStore:
+	"""
+	Returns the shared BlobStore for a destination, creating it on first use.
+	"""
+	destination = pathlib.Path(destination or storage['arguments'].destination)
+
+	with _stores_lock:
+		stores = storage.setdefault('blob_stores', {})
+		if destination not in stores:
+			stores[destination] = BlobStore(destination)
+
+		return stores[destination]
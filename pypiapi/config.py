@@ -0,0 +1,108 @@
+import argparse
+import logging
+import pathlib
+
+from .storage import storage
+
+parser = argparse.ArgumentParser()
+parser.add_argument("command", default='sync', type=str, nargs='?', help="What to do when run as `python -m pypiapi`: sync (default), gc, serve or verify")
+parser.add_argument("--mirror", default='pypi.org', type=str, nargs='?', help="Which upstream host contains the pypi API")
+parser.add_argument("--port", default=443, type=int, nargs='?', help="Which port to connect to against the --mirror")
+parser.add_argument("--tls", default=True, action=argparse.BooleanOptionalAction, help="Enable TLS functionality against the API, --no-tls disables it")
+parser.add_argument("--simple-api", default='/simple', type=str, nargs='?', help="Which endpoint contains the simple API")
+parser.add_argument("--json-api", default='/pypi', type=str, nargs='?', help="Which endpoint contains the JSON API")
+parser.add_argument("--retain-versions", default=3, type=int, nargs='?', help="What is the global retension of versions per package")
+parser.add_argument("--sort-algorithm", default='SpecifierSet', type=str, nargs='?', help="Which version sort algorithm should be applied on --retain-versions")
+parser.add_argument("--destination", default='./cache', type=pathlib.Path, nargs='?', help="Where should we place the package results")
+parser.add_argument("--timeout", default=5, type=int, nargs='?', help="What global timeout should we have on trying to retrieve listings and packages")
+parser.add_argument("--listing-format", default='json', type=str, nargs='?', choices=['json', 'html'], help="Retrieve the package listing as PEP 691 JSON (cached and revalidated between runs) or as PEP 503 HTML")
+parser.add_argument("--count-projects", default=False, action="store_true", help="Scrape the front page of --mirror for the number of projects to report progress against, the HTML listing doesn't include it")
+parser.add_argument("--incremental", default=False, action="store_true", help="Only process packages that changed upstream since the last completed sync (requires --listing-format=json)")
+parser.add_argument("--cache-listing", action="store_true", default=True, help="")
+parser.add_argument("--py-version", default='3.10', type=str, nargs='?', help="Which python version do we support (default to the highest possible)")
+parser.add_argument("--packages", default='', type=str, nargs='?', help="Which packages should we sync, default all. Supports wildcards. Example: --packages 'django*,requests'")
+parser.add_argument("--licenses", default='', type=str, nargs='?', help="Which licenses should we filter on, detaul any. Example: --licenses 'MIT,GPLv3'")
+parser.add_argument("--architectures", default='x86_64,win_amd64,any', type=str, nargs='?', help="Which architectures (x86_64, i686, win32, win_amd64, etc) should we filter on, detaul any. Example: --licenses 'MIT,GPLv3'")
+parser.add_argument("--metadata-ttl", default=86400, type=int, nargs='?', help="How many seconds cached package information is considered fresh before it's revalidated upstream, -1 never revalidates")
+parser.add_argument("--metadata-workers", default=8, type=int, nargs='?', help="How many packages to fetch information for at the same time when prefetching")
+parser.add_argument("--select-workers", default=4, type=int, nargs='?', help="How many packages to select versions and files for at the same time (this includes verifying files already on disk)")
+parser.add_argument("--queue-size", default=256, type=int, nargs='?', help="How many packages may wait between each stage of a sync before the previous stage is held back")
+parser.add_argument("--shard", default=None, type=str, nargs='?', help="Only sync the K:th of N equally sized slices of the packages, in the form K/N (ex. 2/4). Used to split a sync across machines")
+parser.add_argument("--workers", default=1, type=int, nargs='?', help="How many processes to split the sync over, each syncing its own shard of the packages")
+parser.add_argument("--metrics-file", default=None, type=pathlib.Path, nargs='?', help="Write counters and histograms of the sync (requests, cache hits, bytes, hashing etc) to this file")
+parser.add_argument("--metrics-format", default='prometheus', type=str, nargs='?', choices=['prometheus', 'jsonl'], help="Write --metrics-file in the Prometheus text format (replaced each time) or as JSON lines (appended each time)")
+parser.add_argument("--metrics-interval", default=60, type=int, nargs='?', help="How many seconds between each write of --metrics-file during a sync")
+parser.add_argument("--verbosity-level", default='info', type=str, nargs='?', help="Sets the lowest threashold for log messages, according to https://docs.python.org/3/library/logging.html#logging-levels")
+parser.add_argument("--paralell-downloads", default=2, type=int, nargs='?', help="Define how many paralell downloads can simulatniously be allowed to run.")
+parser.add_argument("--rate-limit", default=0, type=float, nargs='?', help="The most requests per second to send to each upstream host, 0 for no limit")
+parser.add_argument("--max-retries", default=3, type=int, nargs='?', help="How many times a request is retried after a timeout, dropped connection, 429 or 5xx response")
+parser.add_argument("--retry-backoff", default=1.0, type=float, nargs='?', help="Seconds to back off before the first retry, doubling with each retry (with random jitter) unless upstream sends Retry-After")
+parser.add_argument("--max-host-concurrency", default=32, type=int, nargs='?', help="The most requests waiting for a response from each upstream host at once, the actual limit adapts to latency and throttling")
+parser.add_argument("--proxy-protocol", default="https", type=str, nargs='?', help="If a --proxy-host is set, which protocol should we use?.")
+parser.add_argument("--proxy-host", default=None, type=str, nargs='?', help="Define a proxy to use (ip or hostname).")
+parser.add_argument("--proxy-port", default=8080, type=int, nargs='?', help="Define a port to connect to the proxy.")
+parser.add_argument("--blob-store", default=False, action="store_true", help="Store each distinct file once under <destination>/.blobs, keyed by its sha256, and hardlink (or symlink) it into the package directories")
+parser.add_argument("--simple-index", default=False, action="store_true", help="Keep a PEP 503 simple index of the downloaded files in <destination>/.simple/, updating the pages of packages that changed")
+parser.add_argument("--bind", default='127.0.0.1', type=str, nargs='?', help="Which address the serve command listens on")
+parser.add_argument("--serve-port", default=8080, type=int, nargs='?', help="Which port the serve command listens on")
+parser.add_argument("--gc", default=False, action="store_true", help="Remove files that are no longer retained from --destination after the sync (see the gc command)")
+parser.add_argument("--dry-run", default=False, action="store_true", help="Only log what the garbage collection would remove")
+parser.add_argument("--report", default=None, type=pathlib.Path, nargs='?', help="Write the corrupt, missing and unexpected files found by the verify command to this file, as JSON")
+parser.add_argument("--verify-deep", default=False, action="store_true", help="Re-hash every previously verified file in --destination before syncing, instead of trusting the artifact index.")
+parser.add_argument("--skip-unknown-py-versions", default=False, action="store_true", help="Enables skipping of packages that haven't defined a PyVersion >X.Y definition.")
+
+def _split(value):
+	if isinstance(value, str):
+		return [item for item in value.split(',') if item]
+
+	return list(value)
+
+def configure(argv=None, **overrides) -> argparse.Namespace:
+	"""
+	Parses command line arguments (default sys.argv) into storage['arguments'],
+	where every part of pypiapi reads its configuration from. Keyword arguments
+	override the parsed values, ex. configure([], destination='/srv/pypi', retain_versions=1).
+	If this isn't called, it's done with sys.argv the first time the configuration is needed.
+	Shared objects (connection pool, filters etc) are built from the configuration on first use,
+	so configure() before using them.
+	"""
+	arguments, unknowns = parser.parse_known_args(argv)
+	for key, value in overrides.items():
+		setattr(arguments, key.replace('-', '_'), value)
+
+	arguments.destination = pathlib.Path(arguments.destination).resolve()
+	arguments.packages = _split(arguments.packages)
+	arguments.licenses = _split(arguments.licenses)
+	arguments.architectures = _split(arguments.architectures)
+
+	if isinstance(arguments.shard, str):
+		try:
+			index, count = (int(part) for part in arguments.shard.split('/', 1))
+		except ValueError:
+			parser.error(f"--shard should be given as K/N, got: {arguments.shard}")
+
+		if not 1 <= index <= count:
+			parser.error(f"--shard {arguments.shard} is out of range, K has to be between 1 and N")
+
+		arguments.shard = (index, count)
+
+	if arguments.workers < 1:
+		parser.error("--workers has to be at least 1")
+
+	if isinstance(arguments.verbosity_level, str):
+		match arguments.verbosity_level.lower():
+			case 'critical':
+				arguments.verbosity_level = logging.CRITICAL
+			case 'error':
+				arguments.verbosity_level = logging.ERROR
+			case 'warning':
+				arguments.verbosity_level = logging.WARNING
+			case 'info':
+				arguments.verbosity_level = logging.INFO
+			case 'debug':
+				arguments.verbosity_level = logging.DEBUG
+			case 'noset':
+				arguments.verbosity_level = logging.NOTSET
+
+	storage['arguments'] = arguments
+	return arguments
@@ -0,0 +1,237 @@
+import http.client
+import io
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+from typing import Dict, List, Tuple
+
+from .storage import storage
+from .logger import log
+from .metrics import metrics
+from .scheduler import request_scheduler, retry_after, THROTTLE_STATUSES
+
+def mirror_url(path :str) -> str:
+	"""
+	Builds a URL against --mirror, honoring --port and --tls.
+	"""
+	scheme = 'https' if storage['arguments'].tls else 'http'
+	default_port = 443 if storage['arguments'].tls else 80
+
+	if storage['arguments'].port and storage['arguments'].port != default_port:
+		return f"{scheme}://{storage['arguments'].mirror}:{storage['arguments'].port}{path}"
+
+	return f"{scheme}://{storage['arguments'].mirror}{path}"
+
+class PooledResponse:
+	"""
+	Wraps a http.client.HTTPResponse and hands the connection back to the
+	pool once the response has been read to the end and closed.
+	"""
+	def __init__(self, pool, key, connection, response, url):
+		self.pool = pool
+		self.key = key
+		self.connection = connection
+		self.response = response
+		self.url = url
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	@property
+	def status(self):
+		return self.response.status
+
+	@property
+	def headers(self):
+		return self.response.headers
+
+	def read(self, amt=None):
+		return self.response.read(amt)
+
+	def read1(self, amt=-1):
+		return self.response.read1(amt)
+
+	def close(self):
+		if self.connection is None:
+			return
+
+		# A connection can only be re-used once the whole response has been consumed
+		if self.response.isclosed() and not self.response.will_close:
+			self.pool.release(self.key, self.connection)
+		else:
+			self.response.close()
+			self.connection.close()
+
+		self.connection = None
+
+class ConnectionPool:
+	"""
+	Keeps idle keep-alive connections per (scheme, host, port), so that the listing,
+	package information and downloads don't pay a TCP and TLS handshake per request.
+	Requests matching --proxy-protocol are sent through --proxy-host, HTTPS ones
+	being tunneled with CONNECT.
+	"""
+	def __init__(self, idle_per_host=16):
+		self.idle_per_host = idle_per_host
+		self.lock = threading.Lock()
+		self.idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+		self._tls_context = None
+
+		if storage['arguments'].proxy_host:
+			log(f"Sending {storage['arguments'].proxy_protocol} requests through --proxy-host {storage['arguments'].proxy_host}:{storage['arguments'].proxy_port}", level=logging.INFO, fg="orange")
+
+	@property
+	def tls_context(self):
+		# Loading the system certificates takes a while, so it's done on the first HTTPS connection
+		with self.lock:
+			if self._tls_context is None:
+				import ssl
+				self._tls_context = ssl.create_default_context()
+
+			return self._tls_context
+
+	def connect(self, scheme, host, port, timeout) -> http.client.HTTPConnection:
+		proxy = None
+		if storage['arguments'].proxy_host and scheme == storage['arguments'].proxy_protocol:
+			proxy = (storage['arguments'].proxy_host, storage['arguments'].proxy_port)
+
+		if scheme == 'https':
+			if proxy:
+				connection = http.client.HTTPSConnection(*proxy, timeout=timeout, context=self.tls_context)
+				connection.set_tunnel(host, port)
+			else:
+				connection = http.client.HTTPSConnection(host, port, timeout=timeout, context=self.tls_context)
+		else:
+			connection = http.client.HTTPConnection(*(proxy or (host, port)), timeout=timeout)
+
+		return connection
+
+	def acquire(self, key, timeout) -> Tuple[http.client.HTTPConnection, bool]:
+		with self.lock:
+			if idle := self.idle.get(key, None):
+				connection = idle.pop()
+				connection.timeout = timeout
+				if connection.sock:
+					connection.sock.settimeout(timeout)
+
+				return connection, True
+
+		return self.connect(*key, timeout), False
+
+	def release(self, key, connection):
+		with self.lock:
+			idle = self.idle.setdefault(key, [])
+			if len(idle) < self.idle_per_host:
+				idle.append(connection)
+				return
+
+		connection.close()
+
+	def exchange(self, key, method, target, headers, timeout) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+		"""
+		Sends a request over a pooled connection and waits for the response headers.
+		"""
+		connection, reused = self.acquire(key, timeout)
+		try:
+			connection.request(method, target, headers=headers)
+			return connection, connection.getresponse()
+		except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+			connection.close()
+			if not reused:
+				raise
+		except BaseException:
+			connection.close()
+			raise
+
+		# The server closed the idle connection, try once more on a fresh one
+		log(f"Re-connecting to {key[1]} after the idle connection was closed", level=logging.DEBUG)
+		connection = self.connect(*key, timeout)
+		try:
+			connection.request(method, target, headers=headers)
+			return connection, connection.getresponse()
+		except BaseException:
+			connection.close()
+			raise
+
+	def urlopen(self, url, headers=None, timeout=None, method='GET', redirects=5) -> PooledResponse:
+		"""
+		Sends a request over a pooled connection and returns the response.
+		Redirects are followed, and any other non-2xx status is raised as
+		urllib.error.HTTPError just like urllib.request.urlopen() would.
+		Requests are paced and retried by the RequestScheduler.
+		"""
+		return request_scheduler().retrying(lambda: self.send(url, headers, timeout, method, redirects), url)
+
+	def send(self, url, headers=None, timeout=None, method='GET', redirects=5) -> PooledResponse:
+		"""
+		Sends a request once, waiting for the host to admit it first (see HostLimiter).
+		"""
+		if timeout is None:
+			timeout = storage['arguments'].timeout
+
+		headers = {'User-Agent': f"python-pypiapi-{storage['version']}", **(headers or {})}
+		parsed = urllib.parse.urlsplit(url)
+		key = (parsed.scheme, parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80))
+
+		target = urllib.parse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+		if parsed.scheme == 'http' and storage['arguments'].proxy_host and storage['arguments'].proxy_protocol == 'http':
+			# Plain HTTP proxies expect the absolute URL
+			target = url
+
+		limiter = request_scheduler().host(parsed.netloc)
+		limiter.acquire()
+
+		started = time.perf_counter()
+		try:
+			connection, response = self.exchange(key, method, target, headers, timeout)
+		except BaseException as error:
+			limiter.release(throttled=request_scheduler().transient(error))
+			raise
+
+		latency = time.perf_counter() - started
+		if response.status in THROTTLE_STATUSES:
+			metrics().counter('pypiapi_throttled_total', "Responses where upstream asked to slow down (429/503)").inc()
+			limiter.release(throttled=True, pause=retry_after(response.headers))
+		else:
+			limiter.release(latency)
+
+		metrics().histogram('pypiapi_request_seconds', "Seconds from sending a request until its response headers arrived").observe(latency)
+		pooled = PooledResponse(self, key, connection, response, url)
+
+		if 300 <= response.status < 400 and response.status != 304 and (location := response.headers.get('Location', None)) and redirects > 0:
+			response.read()
+			pooled.close()
+			return self.urlopen(urllib.parse.urljoin(url, location), headers=headers, timeout=timeout, method=method, redirects=redirects - 1)
+
+		if not 200 <= response.status < 300:
+			body = response.read()
+			pooled.close()
+			raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+		return pooled
+
+	def close(self):
+		with self.lock:
+			for idle in self.idle.values():
+				for connection in idle:
+					connection.close()
+
+			self.idle = {}
+
+
+_pool_lock = threading.Lock()
+
+def connection_pool() -> ConnectionPool:
+	"""
+	Returns the shared ConnectionPool, creating it on first use.
+	"""
+	with _pool_lock:
+		if 'connection_pool' not in storage:
+			storage['connection_pool'] = ConnectionPool()
+
+		return storage['connection_pool']
@@ -0,0 +1,116 @@
+import http.client
+import logging
+import threading
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Optional
+
+from .storage import storage
+from .logger import log
+from .exceptions import IntegrityError
+from .metrics import metrics
+
+def human_bytes(num :float) -> str:
+	for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+		if abs(num) < 1024.0 or unit == 'TiB':
+			break
+		num /= 1024.0
+
+	return f"{num:.1f} {unit}"
+
+class DownloadScheduler:
+	"""
+	Runs file transfers on a bounded pool of worker threads.
+	The number of workers defaults to --paralell-downloads, and at most
+	twice that many files are allowed to be queued before submit() blocks.
+	"""
+	def __init__(self, workers=None):
+		if not workers:
+			workers = storage['arguments'].paralell_downloads
+
+		self.workers = max(1, int(workers))
+		self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pypiapi-download')
+		self.slots = threading.BoundedSemaphore(self.workers * 2)
+		self.lock = threading.Lock()
+
+		self.started = time.time()
+		self.last_report = time.time()
+		self.bytes_downloaded = 0
+		self.files_downloaded = 0
+		self.files_failed = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	@property
+	def throughput(self) -> float:
+		elapsed = time.time() - self.started
+		if elapsed <= 0:
+			return 0.0
+
+		return self.bytes_downloaded / elapsed
+
+	def submit(self, package, version, force=False) -> List[Future]:
+		"""
+		Schedules every file of the given package version for download.
+		Filtering errors (DependencyError, VersionError etc) are raised to the caller
+		before anything is queued, just as Package.download() would.
+		"""
+		files = package.files(version, force=force)
+
+		if files:
+			log(f"Initating download of {package}@version: {version}", fg="yellow", level=logging.INFO)
+
+		futures = []
+		for file in files:
+			self.slots.acquire()
+			try:
+				future = self.executor.submit(self.transfer, package, file)
+			except:
+				self.slots.release()
+				raise
+
+			future.add_done_callback(self._release)
+			futures.append(future)
+
+		return futures
+
+	def transfer(self, package, file) -> Optional[int]:
+		"""
+		Downloads a single file on the calling thread, returning its size or None if it failed.
+		"""
+		try:
+			size = package.download_file(file)
+		except (urllib.error.URLError, OSError, http.client.HTTPException, IntegrityError) as err:
+			log(f"Could not download {file['filename']} due to: {err}", level=logging.ERROR, fg="red")
+			metrics().counter('pypiapi_download_failures_total', "Release files that could not be downloaded").inc()
+			with self.lock:
+				self.files_failed += 1
+			return None
+
+		with self.lock:
+			self.bytes_downloaded += size
+			self.files_downloaded += 1
+
+			report = time.time() - self.last_report > 60
+			if report:
+				self.last_report = time.time()
+
+		if report:
+			self.report()
+
+		return size
+
+	def _release(self, future :Future):
+		self.slots.release()
+
+	def report(self):
+		log(f"Downloaded {self.files_downloaded} files ({human_bytes(self.bytes_downloaded)}) at {human_bytes(self.throughput)}/s using {self.workers} paralell downloads, {self.files_failed} failed", level=logging.INFO, fg="gray")
+
+	def close(self):
+		self.executor.shutdown(wait=True)
+		self.report()
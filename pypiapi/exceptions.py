@@ -8,4 +8,7 @@ class YankedPackage(BaseException):
 	pass
 
 class InvalidPackage(BaseException):
+	pass
+
+class IntegrityError(BaseException):
 	pass
\ No newline at end of file
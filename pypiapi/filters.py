@@ -0,0 +1,167 @@
+import fnmatch
+import functools
+import logging
+import re
+import threading
+import zlib
+from typing import FrozenSet, Optional
+
+from .storage import storage
+from .logger import log
+from .exceptions import DependencyError, VersionError
+from .metrics import metrics
+
+@functools.lru_cache(maxsize=16384)
+def supports_python(requirement :str, py_version :str) -> bool:
+	# packaging is imported on first use, the result is cached per requirement anyway
+	from packaging.specifiers import SpecifierSet, InvalidSpecifier
+
+	try:
+		return SpecifierSet(requirement).contains(py_version)
+	except InvalidSpecifier:
+		return False
+
+@functools.lru_cache(maxsize=65536)
+def wheel_platforms(filename :str) -> Optional[FrozenSet[str]]:
+	"""
+	Returns the platform tags of a wheel (ex. manylinux_2_17_x86_64, win_amd64 or any),
+	or None if the file isn't a (valid) wheel.
+	"""
+	if not filename.endswith('.whl'):
+		return None
+
+	from packaging.utils import parse_wheel_filename, InvalidWheelFilename
+
+	try:
+		_, _, _, tags = parse_wheel_filename(filename)
+	except InvalidWheelFilename:
+		return None
+
+	return frozenset(tag.platform for tag in tags)
+
+def in_shard(name :str, shard) -> bool:
+	"""
+	Returns True if a package belongs to the given (index, count) shard, index starting at 1.
+	The name is hashed with crc32 as it's stable across processes, machines and python versions.
+	"""
+	if not shard:
+		return True
+
+	index, count = shard
+	return zlib.crc32(name.encode('UTF-8')) % count == index - 1
+
+def shard_suffix() -> str:
+	"""
+	Returns the suffix of the per-shard state files (journal, serial, artifact index),
+	so that several shards can sync into the same --destination, or "" when not sharded.
+	"""
+	if not (shard := storage['arguments'].shard):
+		return ''
+
+	return f".shard-{shard[0]}-of-{shard[1]}"
+
+class FilterPipeline:
+	"""
+	The package filters, compiled once from --shard, --packages, --licenses, --py-version
+	and --architectures, and evaluated in stages from cheapest to most expensive:
+
+	* accept_name() runs on the listing, before any package information is fetched.
+	* check_package() runs on the package information, before looking at any files.
+	* accept_file() runs on each release file, before any byte is transferred.
+	"""
+	def __init__(self, packages=None, licenses=None, py_version=None, architectures=None, shard=None):
+		if shard is None:
+			shard = storage['arguments'].shard
+		if packages is None:
+			packages = storage['arguments'].packages
+		if licenses is None:
+			licenses = storage['arguments'].licenses
+		if py_version is None:
+			py_version = storage['arguments'].py_version
+		if architectures is None:
+			architectures = storage['arguments'].architectures
+
+		self.shard = shard
+		self.name_pattern = re.compile('|'.join(fnmatch.translate(pattern) for pattern in packages)) if packages else None
+		self.licenses = licenses
+		self.py_version = py_version
+		self.architectures = [arch.lower() for arch in architectures]
+
+		self.lock = threading.Lock()
+		self.platforms = {}
+		self.rejected = {'name': 0, 'package': 0, 'file': 0}
+
+	def _reject(self, stage :str):
+		with self.lock:
+			self.rejected[stage] += 1
+
+		metrics().counter('pypiapi_filter_rejected_total', "Packages and files rejected by the filters, per stage", stage=stage).inc()
+
+		return False
+
+	def accept_name(self, name :str) -> bool:
+		# Packages of other shards are left to the process syncing that shard, they're not rejected as such
+		if not in_shard(name, self.shard):
+			return False
+
+		if self.name_pattern and self.name_pattern.match(name) is None:
+			return self._reject('name')
+
+		return True
+
+	def check_package(self, package):
+		"""
+		Raises DependencyError (or VersionError) if the package as a whole doesn't
+		meet the license and python version requirements.
+		"""
+		if self.licenses and any([license in package.license for license in self.licenses]) is False:
+			self._reject('package')
+			raise DependencyError(f"Package {package.name}'s license {package.license} does not meet the license requirements: {self.licenses}")
+
+		requirement = package.information.get('info', {}).get('requires_python', None)
+		if not requirement:
+			if storage['arguments'].skip_unknown_py_versions is True:
+				self._reject('package')
+				raise VersionError(f"Package {package} does not have a python version requirement.")
+		elif self.py_version and supports_python(requirement, self.py_version) is False:
+			self._reject('package')
+			raise DependencyError(f"Package {package.name}'s Python versioning {requirement} does not meet the Python version requirements: {self.py_version}")
+
+	def supported_platform(self, filename :str) -> bool:
+		if (platforms := wheel_platforms(filename)) is None:
+			# Not a wheel (eggs, installers etc), fall back to looking for the architecture in the name
+			return any(f"{arch}." in filename.lower() for arch in self.architectures)
+
+		# There are only so many distinct platform combinations, so the verdict is kept per combination
+		if (accepted := self.platforms.get(platforms, None)) is None:
+			accepted = any(platform == arch or platform.endswith(f"_{arch}") for platform in platforms for arch in self.architectures)
+			self.platforms[platforms] = accepted
+
+		return accepted
+
+	def accept_file(self, package, version :str, file :dict, force=False) -> bool:
+		if file.get('python_version', None) == 'source' or file['filename'] == f"{package.name}-{version}.tar.gz":
+			# We always accept the source code, as it can be compiled anywhere.
+			pass
+		elif self.architectures and not self.supported_platform(file['filename']):
+			log(f"  {file['filename']} not in target architectures: {self.architectures}", level=logging.DEBUG, fg="orange")
+			return self._reject('file')
+
+		if force is False and self.py_version and (requirement := file.get('requires_python', None)) and supports_python(requirement, self.py_version) is False:
+			log(f"  {file['filename']} requires python {requirement}", level=logging.DEBUG, fg="orange")
+			return self._reject('file')
+
+		return True
+
+
+_pipeline_lock = threading.Lock()
+
+def filter_pipeline() -> FilterPipeline:
+	"""
+	Returns the shared FilterPipeline, compiling it on first use.
+	"""
+	with _pipeline_lock:
+		if 'filter_pipeline' not in storage:
+			storage['filter_pipeline'] = FilterPipeline()
+
+		return storage['filter_pipeline']
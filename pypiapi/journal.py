@@ -0,0 +1,57 @@
+import os
+import pathlib
+import threading
+
+from .storage import storage
+from .filters import shard_suffix
+
+class SyncJournal:
+	"""
+	Records which packages have been completely handled during a sync, in an
+	append-only <destination>/.journal that is flushed after every entry.
+	If a sync is interrupted, the next run skips the packages already in the
+	journal. The journal is cleared once a sync completes.
+	Each --shard keeps its own journal.
+	"""
+	def __init__(self, destination=None, filename='.journal'):
+		if not destination:
+			destination = storage['arguments'].destination
+
+		self.path = pathlib.Path(destination)/f"{filename}{shard_suffix()}"
+		self.lock = threading.Lock()
+		self.packages = set()
+		self.fh = None
+
+		if self.path.exists():
+			with open(self.path, 'r') as fh:
+				# An interrupted write leaves a line without a newline, which is ignored
+				self.packages = {line[:-1] for line in fh if line.endswith('\n')}
+
+	def __len__(self):
+		return len(self.packages)
+
+	def completed(self, name :str) -> bool:
+		return name in self.packages
+
+	def record(self, name :str):
+		with self.lock:
+			if name in self.packages:
+				return
+
+			if self.fh is None:
+				self.path.parent.mkdir(parents=True, exist_ok=True)
+				self.fh = open(self.path, 'a')
+
+			self.packages.add(name)
+			self.fh.write(f"{name}\n")
+			self.fh.flush()
+
+	def clear(self):
+		with self.lock:
+			if self.fh:
+				self.fh.close()
+				self.fh = None
+
+			self.packages = set()
+			if self.path.exists():
+				os.unlink(self.path)
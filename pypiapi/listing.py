@@ -1,69 +1,457 @@
 import re
-import copy
+import codecs
 import socket
-import ssl
+import sys
 import json
 import logging
 import pathlib
 import urllib.error
-import urllib.request
-import hashlib
+import http.client
+import os
 import time
-from typing import List
+import functools
+from array import array
+from typing import Callable, Iterator, List, Optional, Tuple
 
 from .storage import storage
-from .sockethelpers import epoll, EPOLLIN, EPOLLHUP
 from .logger import log
 from .licenses import licence_classifier_parser
 from .exceptions import VersionError, DependencyError, YankedPackage, InvalidPackage
 from .packages import Package
+from .downloader import DownloadScheduler
+from .metadata import metadata_cache
+from .connections import connection_pool, mirror_url
+from .scheduler import request_scheduler
+from .filters import filter_pipeline, shard_suffix
+from .metrics import metrics
+
+# The listing is read in pieces of at most this size, and parsed as it arrives.
+LISTING_CHUNK_SIZE = 64 * 1024
+
+# PEP 691 content type of the JSON flavour of the simple API
+SIMPLE_JSON = 'application/vnd.pypi.simple.v1+json'
+
+class NameTable:
+	"""
+	The project names (and serials) of a listing, packed into a single buffer.
+	A parsed listing of the full index is a dict per project, this stores
+	all of them in a few MB. Names are interned as they're handed out.
+	"""
+	def __init__(self):
+		self.names = bytearray()
+		self.offsets = array('Q', [0])
+		self.serials = array('q')
+
+	def __len__(self):
+		return len(self.serials)
+
+	def append(self, name :str, serial :Optional[int] = None):
+		self.names += name.encode('UTF-8')
+		self.offsets.append(len(self.names))
+		self.serials.append(-1 if serial is None else serial)
+
+	def __getitem__(self, index :int) -> Tuple[str, Optional[int]]:
+		name = sys.intern(self.names[self.offsets[index]:self.offsets[index+1]].decode('UTF-8'))
+		serial = self.serials[index]
+		return name, (None if serial == -1 else serial)
+
+	def __iter__(self) -> Iterator[Tuple[str, Optional[int]]]:
+		for index in range(len(self)):
+			yield self[index]
+
+class JSONListingParser:
+	"""
+	Parses a PEP 691 project listing incrementally from read(size), yielding each
+	entry of "projects" as soon as it's complete. The other top-level keys (meta)
+	are kept in self.document. Only the unparsed tail of the last chunk is held in memory,
+	instead of the whole (tens of MB) document and a dict per project.
+	"""
+	def __init__(self, read :Callable[[int], bytes], chunk_size=LISTING_CHUNK_SIZE):
+		self.read = read
+		self.chunk_size = chunk_size
+		self.decoder = json.JSONDecoder()
+		self.text = codecs.getincrementaldecoder('UTF-8')()
+		self.buffer = ''
+		self.position = 0
+		self.eof = False
+		self.document = {}
+
+	def fill(self) -> bool:
+		"""
+		Appends the next chunk to the buffer, returns False if there is none.
+		"""
+		if self.eof:
+			return False
+
+		chunk = self.read(self.chunk_size)
+		if not chunk:
+			self.eof = True
+
+		self.buffer = self.buffer[self.position:] + self.text.decode(chunk, final=self.eof)
+		self.position = 0
+		return not self.eof
+
+	def peek(self) -> str:
+		"""
+		Skips whitespace and returns the next character, without consuming it.
+		"""
+		while True:
+			while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+				self.position += 1
+
+			if self.position < len(self.buffer):
+				return self.buffer[self.position]
+
+			if not self.fill():
+				raise ValueError("The JSON listing ended unexpectedly")
+
+	def expect(self, character :str):
+		if (found := self.peek()) != character:
+			raise ValueError(f"Expected {character!r} in the JSON listing, found {found!r}")
+
+		self.position += 1
+
+	def value(self):
+		self.peek()
+
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.position)
+			except json.JSONDecodeError:
+				# The value continues in the next chunk
+				if not self.fill():
+					raise
+				continue
+
+			# So might a number that happens to end where the chunk does
+			if end == len(self.buffer) and self.fill():
+				continue
+
+			self.position = end
+			return value
+
+	def __iter__(self) -> Iterator[dict]:
+		self.expect('{')
+
+		while (character := self.peek()) != '}':
+			if character == ',':
+				self.position += 1
+				continue
+
+			key = self.value()
+			self.expect(':')
+
+			if key != 'projects':
+				self.document[key] = self.value()
+				continue
+
+			self.expect('[')
+			while (character := self.peek()) != ']':
+				if character == ',':
+					self.position += 1
+					continue
+
+				yield self.value()
+
+			self.position += 1
+
+		self.position += 1
 
 class PackageListing:
 	def __init__(self, packages=None):
-		self.socket = None
-		self.pollobj = epoll()
-
-		self.full_buffer = b''
 		self.buffer = b''
 		self.buffer_pos = 0
+		self.received = 0
 		self.expected_content_length = -1
 		self.headers = {}
 
+		self.number_of_projects = None
+		self.last_serial = None
+
 		self._packages = packages
 
-		with urllib.request.urlopen('https://pypi.org/') as f:
-			self.number_of_projects = int(re.findall('([0-9,.]+) (projects)', f.read().decode('utf-8'))[0][0].replace(',', '').replace('.', ''))
+	def count_projects(self):
+		# The HTML listing doesn't say how many projects there are,
+		# so we have to resort to scraping the front page for it.
+		def request():
+			with connection_pool().urlopen(mirror_url('/')) as f:
+				return f.read().decode('utf-8')
+
+		page = request_scheduler().retrying(request, mirror_url('/'))
+		self.number_of_projects = int(re.findall('([0-9,.]+) (projects)', page)[0][0].replace(',', '').replace('.', ''))
 
 		log(f"Found that there should be {self.number_of_projects} number of projects", level=logging.INFO, fg="gray")
 
 	def __iter__(self):
 		log(f"Retrieving raw package list", level=logging.DEBUG, fg="gray")
-		with urllib.request.urlopen('https://pypi.org/simple/') as f:
-			data = f.read()
 
 		last_package_count_update = time.time()-60
 		package_count = 0
 
-		for line in data.split(b'\n'):
-			if b'<a href=' in line:
-				package_url_start = line.find(b'href=')
-				package_url_end = line.find(b'"', package_url_start+6)
+		since = None
+		unfinished = set()
+		if storage['arguments'].incremental:
+			if storage['arguments'].listing_format != 'json':
+				log(f"--incremental requires --listing-format=json, processing all packages", level=logging.WARNING, fg="orange")
+			elif (since := self.stored_serial()) is not None:
+				unfinished = self.stored_unfinished()
+				log(f"Only processing packages changed since serial {since}, and {len(unfinished)} left unfinished by the last sync", level=logging.INFO, fg="gray")
 
-				package_url = line[package_url_start+6:package_url_end].decode('UTF-8')
-				package_name = pathlib.Path(package_url).name
+		if storage['arguments'].listing_format == 'json':
+			package_names = self.projects(mirror_url(f"{storage['arguments'].simple_api}/"), since=since, unfinished=unfinished)
+		else:
+			if storage['arguments'].count_projects:
+				self.count_projects()
+			package_names = ((package_name, None) for package_name in self.stream(mirror_url(f"{storage['arguments'].simple_api}/")))
 
-				package_count += 1
+		pipeline = filter_pipeline()
 
-				if self._packages and package_name not in self._packages:
-					continue
+		for package_name, serial in package_names:
+			package_count += 1
 
-				package = Package(package_name)
-				
-				yield package
+			if self._packages and package_name not in self._packages:
+				continue
 
-				if time.time() - last_package_count_update > 60:
-					log(f"Processing package {package_count}/{self.number_of_projects} @ {package}", level=logging.INFO, fg="gray")
-					last_package_count_update = time.time()
+			if not pipeline.accept_name(package_name):
+				continue
+
+			package = Package(package_name, serial=serial)
+			metrics().counter('pypiapi_packages_listed_total', "Packages yielded by the listing after filtering").inc()
+
+			yield package
+
+			if time.time() - last_package_count_update > 60:
+				progress = f" ({self.received}/{self.expected_content_length} bytes of listing)" if self.received else ""
+				total = f"/{self.number_of_projects}" if self.number_of_projects else ""
+				log(f"Processing package {package_count}{total} @ {package}{progress}", level=logging.INFO, fg="gray")
+				last_package_count_update = time.time()
+
+	def name_filter(self) -> str:
+		"""
+		Describes the --packages patterns and packages= names the listing is limited to, '' if it isn't.
+		"""
+		if not (storage['arguments'].packages or self._packages):
+			return ''
+
+		return f"{','.join(sorted(storage['arguments'].packages))};{','.join(sorted(self._packages or []))}"
+
+	def stored_serial(self):
+		"""
+		Returns the listing serial recorded by commit_serial() during the last completed sync,
+		unless that sync was limited to other packages than this one (see name_filter()).
+		"""
+		try:
+			with open(storage['arguments'].destination/f".last-serial{shard_suffix()}", 'r') as fh:
+				serial, _, name_filter = fh.read().partition('\n')
+				serial = int(serial)
+		except (FileNotFoundError, ValueError):
+			return None
+
+		if name_filter.strip() != self.name_filter():
+			log(f"The last sync was limited to other packages, processing all packages", level=logging.INFO, fg="gray")
+			return None
+
+		return serial
+
+	def stored_unfinished(self) -> set:
+		"""
+		Returns the packages the last completed sync could not finish (see commit_serial()).
+		"""
+		try:
+			with open(storage['arguments'].destination/f".unfinished{shard_suffix()}", 'r') as fh:
+				return {line[:-1] for line in fh if line.endswith('\n')}
+		except FileNotFoundError:
+			return set()
+
+	def commit_serial(self, unfinished=()):
+		"""
+		Records the serial of the listing, so that the next --incremental run only
+		processes packages that changed after it. Call this once the sync has completed.
+		Packages that failed (information or files that couldn't be fetched) are recorded
+		in .unfinished, and the next --incremental run processes them again regardless of their serial.
+		Each --shard records its own serial, as shards complete independently of each other,
+		and the serial is stored along with the name filter it applies to.
+		"""
+		if self.last_serial is None:
+			return
+
+		path = storage['arguments'].destination/f".last-serial{shard_suffix()}"
+		unfinished_path = storage['arguments'].destination/f".unfinished{shard_suffix()}"
+
+		storage['arguments'].destination.mkdir(parents=True, exist_ok=True)
+		with open(f"{path}.{os.getpid()}.tmp", 'w') as fh:
+			fh.write(f"{self.last_serial}\n{self.name_filter()}\n")
+		with open(f"{unfinished_path}.{os.getpid()}.tmp", 'w') as fh:
+			fh.writelines(f"{name}\n" for name in sorted(unfinished))
+
+		# The unfinished packages are replaced first, so a serial is never stored without them
+		os.replace(f"{unfinished_path}.{os.getpid()}.tmp", unfinished_path)
+		os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+	def projects(self, url, since=None, unfinished=()):
+		"""
+		Fetches the PEP 691 JSON listing and yields the normalized project names
+		together with the serial of their last change.
+		If since is given, only projects changed after that serial (or in unfinished) are yielded.
+		A previously cached listing under --destination is revalidated with its
+		ETag/Last-Modified, and re-used as-is if the mirror answers 304 Not Modified.
+		Mirrors that only speak the HTML format are streamed through parse_stream().
+		"""
+		cache = storage['arguments'].destination/'.simple.json'
+		validators = storage['arguments'].destination/'.simple.json.headers'
+
+		headers = {'Accept': f"{SIMPLE_JSON}, text/html;q=0.01"}
+		if cache.exists() and validators.exists():
+			with open(validators, 'r') as fh:
+				cached_headers = json.load(fh)
+
+			if etag := cached_headers.get('ETag', None):
+				headers['If-None-Match'] = etag
+			if last_modified := cached_headers.get('Last-Modified', None):
+				headers['If-Modified-Since'] = last_modified
+
+		def request():
+			f = connection_pool().urlopen(url, headers=headers)
+			if not f.headers.get('Content-Type', '').startswith(SIMPLE_JSON):
+				return f, None
+
+			# The listing is parsed as it arrives and written to the cache along the way, so only the packed
+			# names are kept in memory. Shards running in paralell share the cache, so each writes its own temporary file.
+			storage['arguments'].destination.mkdir(parents=True, exist_ok=True)
+			length = int(f.headers.get('Content-Length', -1))
+			received = 0
+
+			with f, open(f"{cache}.{os.getpid()}.tmp", 'wb') as fh:
+				def read(size):
+					nonlocal received
+
+					chunk = f.read1(size)
+					received += len(chunk)
+					if not chunk and 0 < length and received < length:
+						# A transfer that breaks off half way is requested again (see RequestScheduler)
+						raise http.client.IncompleteRead(b'', length - received)
+
+					fh.write(chunk)
+					return chunk
+
+				return f, self.pack(read, since=since, unfinished=unfinished)
+
+		try:
+			f, names = request_scheduler().retrying(request, url)
+		except urllib.error.HTTPError as error:
+			if error.code != 304:
+				raise
+
+			self.headers = dict(error.headers)
+			log(f"Package listing has not changed since the last run, using {cache}", level=logging.INFO, fg="gray")
+			with open(cache, 'rb') as fh:
+				names = self.pack(fh.read, since=since, unfinished=unfinished)
+		else:
+			if names is None:
+				with f:
+					log(f"{url} does not support {SIMPLE_JSON}, falling back to the HTML listing", level=logging.WARNING, fg="orange")
+					if storage['arguments'].count_projects:
+						self.count_projects()
+					for package_name in self.parse_stream(f):
+						yield package_name, None
+				return
+
+			self.headers = dict(f.headers)
+			with open(f"{validators}.{os.getpid()}.tmp", 'w') as fh:
+				json.dump({key: self.headers[key] for key in ('ETag', 'Last-Modified') if key in self.headers}, fh)
+
+			os.replace(f"{cache}.{os.getpid()}.tmp", cache)
+			os.replace(f"{validators}.{os.getpid()}.tmp", validators)
+
+		if self.last_serial is None and 'X-PyPI-Last-Serial' in self.headers:
+			self.last_serial = int(self.headers['X-PyPI-Last-Serial'])
+		log(f"Found that there should be {self.number_of_projects} number of projects", level=logging.INFO, fg="gray")
+
+		yield from names
+
+	def pack(self, read :Callable[[int], bytes], since=None, unfinished=()) -> NameTable:
+		"""
+		Parses a JSON listing from read(size) into a NameTable of the normalized project names,
+		leaving out projects that haven't changed after the serial since (if given) and aren't unfinished.
+		"""
+		from packaging.utils import canonicalize_name
+
+		parser = JSONListingParser(read)
+		names = NameTable()
+
+		count = 0
+		for project in parser:
+			count += 1
+
+			name = canonicalize_name(project['name'])
+			serial = project.get('_last-serial', None)
+			if since is not None and serial is not None and serial <= since and name not in unfinished:
+				continue
+
+			names.append(name, serial)
+
+		self.number_of_projects = count
+		self.last_serial = parser.document.get('meta', {}).get('_last-serial', None)
+
+		return names
+
+	def stream(self, url):
+		"""
+		Streams the HTML simple API listing and yields package names as they arrive.
+		"""
+		with connection_pool().urlopen(url) as f:
+			yield from self.parse_stream(f)
+
+	def parse_stream(self, f):
+		"""
+		Yields package names as soon as their anchor has arrived, instead of
+		waiting for the whole (tens of MB) page.
+		Only the unparsed tail of the last chunk is kept in self.buffer.
+		If no data arrives within --timeout seconds, the listing is aborted.
+		"""
+		self.buffer = b''
+		self.buffer_pos = 0
+		self.received = 0
+
+		self.headers = dict(f.headers)
+		self.expected_content_length = int(f.headers.get('Content-Length', -1))
+
+		try:
+			while chunk := f.read1(LISTING_CHUNK_SIZE):
+				self.received += len(chunk)
+				self.buffer = self.buffer[self.buffer_pos:] + chunk
+				self.buffer_pos = 0
+
+				yield from self.parse_buffer()
+		except (socket.timeout, TimeoutError):
+			log(f"Aborting package listing, no data received within {storage['arguments'].timeout} seconds", level=logging.ERROR, fg="red")
+
+	def parse_buffer(self):
+		"""
+		Yields the package name of every complete <a href="..."> in self.buffer,
+		advancing self.buffer_pos past whatever has been consumed.
+		"""
+		while (package_url_start := self.buffer.find(b'href="', self.buffer_pos)) != -1:
+			package_url_end = self.buffer.find(b'"', package_url_start+6)
+			if package_url_end == -1:
+				# The anchor continues in the next chunk
+				self.buffer_pos = package_url_start
+				return
+
+			package_url = self.buffer[package_url_start+6:package_url_end].decode('UTF-8')
+			self.buffer_pos = package_url_end+1
+
+			yield pathlib.Path(package_url).name
+
+		# Keep enough of the tail to detect a href=" that is split between chunks
+		self.buffer_pos = max(self.buffer_pos, len(self.buffer)-5)
+
+	def prefetch_information(self, concurrency=None):
+		"""
+		Iterates the listing like __iter__(), but loads the information of up to
+		`concurrency` (default --metadata-workers) packages at once before yielding them.
+		"""
+		yield from metadata_cache().prefetch(self, concurrency=concurrency)
 
 	@property
 	def filter_packages(self):
@@ -77,6 +465,17 @@ class PackageListing:
 			return False
 
 	def download(self):
-		for package in self:
-			for version in package.versions():
-				package.download(version, force=True)
\ No newline at end of file
+		unfinished = set()
+
+		def completed(future, name):
+			# transfer() returns None for files that failed, their packages are processed again by the next --incremental run
+			if future.result() is None:
+				unfinished.add(name)
+
+		with DownloadScheduler() as scheduler:
+			for package in self:
+				for version in package.versions():
+					for future in scheduler.submit(package, version, force=True):
+						future.add_done_callback(functools.partial(completed, name=package.name))
+
+		self.commit_serial(unfinished)
\ No newline at end of file
@@ -1,15 +1,24 @@
+import atexit
+import functools
 import logging
 import os
+import pathlib
 import sys
+import threading
+import time
 
 from .storage import storage
 
+# How often buffered log output is written out, warnings and errors are written immediately
+FLUSH_INTERVAL = 0.5
+
 # Found first reference here: https://stackoverflow.com/questions/7445658/how-to-detect-if-the-console-does-support-ansi-escape-codes-in-python
 # And re-used this: https://github.com/django/django/blob/master/django/core/management/color.py#L12
+@functools.lru_cache(maxsize=None)
 def supports_color():
 	"""
 	Return True if the running system's terminal supports color,
-	and False otherwise.
+	and False otherwise. This is only checked once, on the first log().
 	"""
 	supported_platform = sys.platform != 'win32' or 'ANSICON' in os.environ
 
@@ -62,8 +71,107 @@ def stylize_output(text: str, *opts :str, **kwargs) -> str:
 
 	return '%s%s' % (('\x1b[%sm' % ';'.join(code_list)), text or '')
 
+class LogWriter:
+	"""
+	Writes log lines to stdout and to the log file in storage['LOG_FILE'] (under storage['LOG_PATH']).
+	The log file is kept open between calls, and both are flushed by a background thread every
+	FLUSH_INTERVAL seconds rather than after every line. Warnings and errors are flushed right away.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.location = None
+		self.fh = None
+		self.dirty = False
+		self.thread = None
+
+	def _open(self, location):
+		path, filename = location
+		absolute_logfile = pathlib.Path(path)/filename
+		warning = None
+
+		try:
+			absolute_logfile.parent.mkdir(exist_ok=True, parents=True)
+			fh = open(absolute_logfile, 'a')
+		except PermissionError:
+			# Fallback to creating the log file in the current folder
+			fallback = pathlib.Path('./').absolute()/filename
+			warning = f"Not enough permission to place log file at {absolute_logfile}, creating it in {fallback} instead."
+			fallback.parent.mkdir(exist_ok=True)
+			fh = open(fallback, 'a')
+			storage['LOG_PATH'] = './'
+			location = ('./', filename)
+
+		if self.fh:
+			self.fh.close()
+
+		self.fh = fh
+		self.location = location
+		return warning
+
+	def _start(self):
+		self.thread = threading.Thread(target=self._run, name='pypiapi-log', daemon=True)
+		self.thread.start()
+		atexit.register(self.flush)
+
+	def _run(self):
+		while True:
+			time.sleep(FLUSH_INTERVAL)
+			if self.dirty:
+				self.flush()
+
+	def write(self, console=None, logfile=None, location=None, urgent=False):
+		"""
+		Writes `console` to stdout and `logfile` to the log file at `location`, a (LOG_PATH, LOG_FILE) pair.
+		"""
+		warning = None
+
+		with self.lock:
+			if self.thread is None:
+				self._start()
+
+			if logfile is not None:
+				if location != self.location:
+					warning = self._open(location)
+				self.fh.write(logfile)
+
+			if console is not None:
+				sys.stdout.write(console)
+
+			self.dirty = True
+
+		if urgent:
+			self.flush()
+
+		if warning:
+			log(warning, fg="red")
+
+	def flush(self):
+		with self.lock:
+			self.dirty = False
+			if self.fh:
+				self.fh.flush()
+
+		sys.stdout.flush()
+
+
+writer = LogWriter()
+
 def log(*args, **kwargs):
+	level = kwargs.get('level', None)
+	filename = storage.get('LOG_FILE', None)
+
+	# Messages below the output level are dropped before doing any work,
+	# unless there's a log file, as log files get *ALL* the output despite level restrictions.
+	hidden = level is not None and 'force' not in kwargs and level < storage['arguments'].verbosity_level
+	if hidden and not filename:
+		return None
+
 	string = orig_string = ' '.join([str(x) for x in args])
+	urgent = level is not None and level >= logging.WARNING
+
+	if hidden:
+		writer.write(logfile=f"{orig_string}\n", location=(storage.get('LOG_PATH', './'), filename), urgent=urgent)
+		return None
 
 	# Attempt to colorize the output if supported
 	# Insert default colors and override with **kwargs
@@ -71,38 +179,8 @@ def log(*args, **kwargs):
 		kwargs = {'fg': 'white', **kwargs}
 		string = stylize_output(string, **kwargs)
 
-	# If a logfile is defined in storage,
-	# we use that one to output everything
-	if filename := storage.get('LOG_FILE', None):
-		absolute_logfile = os.path.join(storage.get('LOG_PATH', './'), filename)
-
-		try:
-			Path(absolute_logfile).parents[0].mkdir(exist_ok=True, parents=True)
-			with open(absolute_logfile, 'a') as log_file:
-				log_file.write("")
-		except PermissionError:
-			# Fallback to creating the log file in the current folder
-			err_string = f"Not enough permission to place log file at {absolute_logfile}, creating it in {Path('./').absolute() / filename} instead."
-			absolute_logfile = Path('./').absolute() / filename
-			absolute_logfile.parents[0].mkdir(exist_ok=True)
-			absolute_logfile = str(absolute_logfile)
-			storage['LOG_PATH'] = './'
-			log(err_string, fg="red")
-
-		with open(absolute_logfile, 'a') as log_file:
-			log_file.write(f"{orig_string}\n")
-
-	# If we assigned a level, try to log it to systemd's journald.
-	# Unless the level is higher than we've decided to output interactively.
-	# (Remember, log files still get *ALL* the output despite level restrictions)
-	if 'level' in kwargs:
-		if kwargs['level'] < storage['arguments'].verbosity_level and 'force' not in kwargs:
-			# Level on log message was Debug, but output level is set to Info.
-			# In that case, we'll drop it.
-			return None
-
-	# Finally, print the log unless we skipped it based on level.
-	# We use sys.stdout.write()+flush() instead of print() to try and
-	# fix issue #94
-	sys.stdout.write(f"{string}\n")
-	sys.stdout.flush()
\ No newline at end of file
+	# The log file gets the uncolored text
+	if filename:
+		writer.write(console=f"{string}\n", logfile=f"{orig_string}\n", location=(storage.get('LOG_PATH', './'), filename), urgent=urgent)
+	else:
+		writer.write(console=f"{string}\n", urgent=urgent)
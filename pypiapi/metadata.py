@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import zlib
+import urllib.error
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List
+
+from .storage import storage
+from .logger import log
+from .exceptions import InvalidPackage
+from .connections import connection_pool, mirror_url
+from .scheduler import request_scheduler
+from .metrics import metrics
+
+# The parts of a JSON API document that are used when selecting and downloading files.
+# Everything else (descriptions, urls, vulnerabilities etc) is dropped before storing it.
+INFO_FIELDS = ('name', 'version', 'requires_python', 'classifiers', 'license', 'yanked')
+FILE_FIELDS = ('filename', 'url', 'digests', 'requires_python', 'python_version', 'packagetype', 'size', 'yanked')
+
+def compact_document(document :dict) -> dict:
+	return {
+		'info': {key: document['info'][key] for key in INFO_FIELDS if key in document.get('info', {})},
+		'last_serial': document.get('last_serial', 0),
+		'releases': {
+			version: [{key: file[key] for key in FILE_FIELDS if key in file} for file in files]
+			for version, files in document.get('releases', {}).items()
+		}
+	}
+
+class MetadataStore:
+	"""
+	Keeps the compacted JSON API document of every package in a single
+	SQLite database (<destination>/.metadata.sqlite) instead of one file per package.
+	Documents are stored as zlib compressed JSON and loaded by name when needed.
+	"""
+	def __init__(self, destination=None, filename='.metadata.sqlite'):
+		if not destination:
+			destination = storage['arguments'].destination
+
+		self.root = pathlib.Path(destination)
+		self.root.mkdir(parents=True, exist_ok=True)
+		self.path = self.root/filename
+		self.lock = threading.Lock()
+
+		import sqlite3
+
+		# Several processes may share the store (see --shard), WAL lets readers and a writer co-exist
+		self.database = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+		self.database.execute("PRAGMA journal_mode=WAL")
+		self.database.execute("PRAGMA synchronous=NORMAL")
+		self.database.execute("CREATE TABLE IF NOT EXISTS packages (name TEXT PRIMARY KEY, last_serial INTEGER, etag TEXT, last_modified TEXT, fetched REAL, document BLOB)")
+		self.database.commit()
+
+	def __len__(self):
+		with self.lock:
+			return self.database.execute("SELECT COUNT(*) FROM packages").fetchone()[0]
+
+	def __contains__(self, name):
+		with self.lock:
+			return self.database.execute("SELECT 1 FROM packages WHERE name = ?", (name,)).fetchone() is not None
+
+	def names(self) -> List[str]:
+		with self.lock:
+			return [row[0] for row in self.database.execute("SELECT name FROM packages ORDER BY name")]
+
+	def get(self, name):
+		"""
+		Returns the document and validators of a package, and how old they are in seconds.
+		"""
+		with self.lock:
+			row = self.database.execute("SELECT document, etag, last_modified, fetched FROM packages WHERE name = ?", (name,)).fetchone()
+
+		if row is None:
+			return None, {}, None
+
+		document, etag, last_modified, fetched = row
+		validators = {key: value for key, value in (('ETag', etag), ('Last-Modified', last_modified)) if value}
+
+		return json.loads(zlib.decompress(document)), validators, time.time() - fetched
+
+	def put(self, name, document, validators=None, fetched=None):
+		if validators is None:
+			validators = {}
+		if fetched is None:
+			fetched = time.time()
+
+		data = zlib.compress(json.dumps(document, separators=(',', ':')).encode('UTF-8'))
+		with self.lock:
+			self.database.execute(
+				"INSERT OR REPLACE INTO packages (name, last_serial, etag, last_modified, fetched, document) VALUES (?, ?, ?, ?, ?, ?)",
+				(name, document.get('last_serial', 0), validators.get('ETag', None), validators.get('Last-Modified', None), fetched, data)
+			)
+			self.database.commit()
+
+	def touch(self, name):
+		with self.lock:
+			self.database.execute("UPDATE packages SET fetched = ? WHERE name = ?", (time.time(), name))
+			self.database.commit()
+
+	def remove(self, name):
+		with self.lock:
+			self.database.execute("DELETE FROM packages WHERE name = ?", (name,))
+			self.database.commit()
+
+	def close(self):
+		with self.lock:
+			self.database.close()
+
+class MetadataCache:
+	"""
+	Caches the JSON API document of packages, in memory (the `size` most recently used)
+	and on disk in the MetadataStore of the destination.
+	Documents that are older than --metadata-ttl seconds, or older than the serial
+	the listing reported for the package, are revalidated upstream using their
+	stored ETag/Last-Modified.
+	"""
+	def __init__(self, size=1024, ttl=None):
+		if ttl is None:
+			ttl = storage['arguments'].metadata_ttl
+
+		self.size = size
+		self.ttl = ttl
+		self.lock = threading.Lock()
+		self.documents = OrderedDict()
+
+	def _remember(self, name, document):
+		with self.lock:
+			self.documents[name] = document
+			self.documents.move_to_end(name)
+
+			while len(self.documents) > self.size:
+				self.documents.popitem(last=False)
+
+	def _recall(self, name):
+		with self.lock:
+			if (document := self.documents.get(name, None)) is not None:
+				self.documents.move_to_end(name)
+
+			return document
+
+	def read(self, package):
+		"""
+		Returns the stored document and validators of a package, and how old they are in seconds.
+		Documents left behind as <name>/<name>.json by earlier versions are moved into the store.
+		"""
+		store = metadata_store(package.destination.parent)
+		document, validators, age = store.get(package.name)
+
+		if document is None and (package.destination/f"{package.name}.json").exists():
+			try:
+				with open(package.destination/f"{package.name}.json", "r") as fh:
+					document = compact_document(json.load(fh))
+			except json.JSONDecodeError:
+				return None, {}, None
+
+			if (package.destination/f"{package.name}.json.headers").exists():
+				with open(package.destination/f"{package.name}.json.headers", "r") as fh:
+					validators = json.load(fh)
+
+			age = time.time() - os.stat(package.destination/f"{package.name}.json").st_mtime
+			store.put(package.name, document, validators, fetched=time.time() - age)
+
+		return document, validators, age
+
+	def write(self, package, document, validators=None):
+		metadata_store(package.destination.parent).put(package.name, document, validators)
+
+	def touch(self, package):
+		metadata_store(package.destination.parent).touch(package.name)
+
+	def fetch(self, package, validators=None):
+		"""
+		Requests the document of a package from the JSON API.
+		Returns the document and its validators, or None for the document if
+		the given validators were still valid (304 Not Modified).
+		"""
+		url = mirror_url(f"{storage['arguments'].json_api}/{package.name}/json")
+		headers = {}
+		if validators and validators.get('ETag', None):
+			headers['If-None-Match'] = validators['ETag']
+		if validators and validators.get('Last-Modified', None):
+			headers['If-Modified-Since'] = validators['Last-Modified']
+
+		log(f"Sending request to {url}", level=logging.DEBUG)
+
+		def request():
+			with connection_pool().urlopen(url, headers=headers) as response:
+				return json.loads(response.read().decode('UTF-8')), {key: response.headers[key] for key in ('ETag', 'Last-Modified') if key in response.headers}
+
+		try:
+			# Retrying the whole exchange also covers responses that are cut off while being read
+			document, validators = request_scheduler().retrying(request, url)
+		except urllib.error.HTTPError as error:
+			if error.code == 304:
+				return None, validators
+
+			log(f"Invalid package URL was detected, cannot return inforamtion for {package.name}: {error}", level=logging.ERROR, fg="orange")
+			raise InvalidPackage(f"Package URL returned an error '{error.status}' for package: {package.name}")
+
+		return document, validators
+
+	def get(self, package) -> dict:
+		"""
+		Returns the document of a package, from memory, disk or upstream (in that order),
+		revalidating it first if it's no longer considered fresh.
+		"""
+		if (document := self._recall(package.name)) is not None:
+			if not package.serial or document.get('last_serial', 0) >= package.serial:
+				metrics().counter('pypiapi_metadata_cache_hits_total', "Package information served without asking upstream", source='memory').inc()
+				return document
+
+		document, validators, age = self.read(package)
+
+		if document is not None:
+			outdated = package.serial and document.get('last_serial', 0) < package.serial
+			expired = self.ttl >= 0 and age > self.ttl
+
+			if not outdated and not expired:
+				metrics().counter('pypiapi_metadata_cache_hits_total', "Package information served without asking upstream", source='store').inc()
+				self._remember(package.name, document)
+				return document
+
+			if outdated:
+				log(f"Package {package.name} changed upstream (serial {document.get('last_serial', 0)} -> {package.serial}), refreshing its information", level=logging.DEBUG)
+				validators = {}
+
+		fetched, validators = self.fetch(package, validators)
+
+		if fetched is None:
+			metrics().counter('pypiapi_metadata_not_modified_total', "Package information revalidated upstream without changes").inc()
+			self.touch(package)
+		else:
+			metrics().counter('pypiapi_metadata_fetched_total', "Package information downloaded from upstream").inc()
+			document = compact_document(fetched)
+			self.write(package, document, validators)
+
+		self._remember(package.name, document)
+		return document
+
+	def put(self, package, document):
+		self.write(package, compact_document(document))
+		self._remember(package.name, document)
+
+	def prefetch(self, packages :Iterable, concurrency=None) -> Iterator:
+		"""
+		Loads the information of many packages at once on `concurrency` threads,
+		yielding each package once its cache has been filled. Packages that
+		can't be loaded are logged and skipped.
+		"""
+		if not concurrency:
+			concurrency = storage['arguments'].metadata_workers
+
+		def load(package):
+			try:
+				package.load_information()
+			except InvalidPackage as err:
+				log(f"Skipping package {package} due to: {err}", level=logging.WARNING, fg="orange")
+				return None
+
+			return package
+
+		with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='pypiapi-metadata') as executor:
+			pending = deque()
+			for package in packages:
+				pending.append(executor.submit(load, package))
+
+				# Keep a bounded window of requests in flight
+				while len(pending) >= concurrency * 2:
+					if (loaded := pending.popleft().result()) is not None:
+						yield loaded
+
+			for future in pending:
+				if (loaded := future.result()) is not None:
+					yield loaded
+
+
+_cache_lock = threading.Lock()
+
+def metadata_store(destination=None) -> MetadataStore:
+	"""
+	Returns the shared MetadataStore for a destination, opening it on first use.
+	"""
+	destination = pathlib.Path(destination or storage['arguments'].destination)
+
+	with _cache_lock:
+		stores = storage.setdefault('metadata_stores', {})
+		if destination not in stores:
+			stores[destination] = MetadataStore(destination)
+
+		return stores[destination]
+
+def metadata_cache() -> MetadataCache:
+	"""
+	Returns the shared MetadataCache, creating it on first use.
+	"""
+	with _cache_lock:
+		if 'metadata_cache' not in storage:
+			storage['metadata_cache'] = MetadataCache()
+
+		return storage['metadata_cache']
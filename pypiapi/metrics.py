@@ -0,0 +1,228 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from .storage import storage
+from .logger import log
+
+# Upper bounds (in seconds) of the latency histograms, the last bucket is +Inf
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _labels(labels :Tuple[Tuple[str, str], ...], **extra) -> str:
+	pairs = [*labels, *extra.items()]
+	if not pairs:
+		return ''
+
+	return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+class Counter:
+	kind = 'counter'
+
+	def __init__(self, registry, name :str, labels :Tuple[Tuple[str, str], ...]):
+		self.registry = registry
+		self.name = name
+		self.labels = labels
+		self.lock = threading.Lock()
+		self.value = 0
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value += amount
+
+		self.registry.notify(self, amount)
+
+	def snapshot(self):
+		return self.value
+
+	def prometheus(self) -> List[str]:
+		return [f"{self.name}{_labels(self.labels)} {self.value}"]
+
+class Histogram:
+	kind = 'histogram'
+
+	def __init__(self, registry, name :str, labels :Tuple[Tuple[str, str], ...], buckets=DEFAULT_BUCKETS):
+		self.registry = registry
+		self.name = name
+		self.labels = labels
+		self.buckets = tuple(buckets)
+		self.lock = threading.Lock()
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value :float):
+		with self.lock:
+			self.counts[bisect.bisect_left(self.buckets, value)] += 1
+			self.count += 1
+			self.sum += value
+
+		self.registry.notify(self, value)
+
+	@contextlib.contextmanager
+	def time(self):
+		"""
+		Observes how many seconds the with-block took.
+		"""
+		started = time.perf_counter()
+		try:
+			yield self
+		finally:
+			self.observe(time.perf_counter() - started)
+
+	def snapshot(self):
+		with self.lock:
+			return {'count': self.count, 'sum': self.sum, 'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts))}
+
+	def prometheus(self) -> List[str]:
+		with self.lock:
+			counts, count, total = list(self.counts), self.count, self.sum
+
+		lines = []
+		cumulative = 0
+		for bound, bucket in zip([*map(str, self.buckets), '+Inf'], counts):
+			cumulative += bucket
+			lines.append(f"{self.name}_bucket{_labels(self.labels, le=bound)} {cumulative}")
+
+		lines.append(f"{self.name}_sum{_labels(self.labels)} {total}")
+		lines.append(f"{self.name}_count{_labels(self.labels)} {count}")
+		return lines
+
+class Metrics:
+	"""
+	A registry of counters and histograms describing what a sync spends its time on.
+	Hooks registered with subscribe() are called as callback(metric, value) on every
+	increment or observation, and the whole registry can be written to --metrics-file
+	in the Prometheus text format or as JSON lines.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.metrics: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], object] = {}
+		self.descriptions: Dict[str, str] = {}
+		self.hooks: List[Callable] = []
+		self.stopping = threading.Event()
+		self.thread = None
+
+	def _get(self, cls, name :str, description :str, labels :dict, **kwargs):
+		key = (name, tuple(sorted(labels.items())))
+
+		# Metrics are created once and then only looked up, which doesn't need the lock
+		if (metric := self.metrics.get(key, None)) is not None:
+			return metric
+
+		with self.lock:
+			if (metric := self.metrics.get(key, None)) is None:
+				metric = self.metrics[key] = cls(self, name, key[1], **kwargs)
+				self.descriptions.setdefault(name, description)
+
+			return metric
+
+	def counter(self, name :str, description='', **labels) -> Counter:
+		return self._get(Counter, name, description, labels)
+
+	def histogram(self, name :str, description='', buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+		return self._get(Histogram, name, description, labels, buckets=buckets)
+
+	def subscribe(self, callback :Callable):
+		with self.lock:
+			self.hooks.append(callback)
+
+	def unsubscribe(self, callback :Callable):
+		with self.lock:
+			self.hooks.remove(callback)
+
+	def notify(self, metric, value):
+		for hook in self.hooks:
+			hook(metric, value)
+
+	def snapshot(self) -> dict:
+		return {f"{metric.name}{_labels(metric.labels)}": metric.snapshot() for metric in list(self.metrics.values())}
+
+	def prometheus(self) -> str:
+		lines = []
+		described = set()
+		for metric in sorted(list(self.metrics.values()), key=lambda metric: (metric.name, metric.labels)):
+			if metric.name not in described:
+				described.add(metric.name)
+				lines.append(f"# HELP {metric.name} {self.descriptions.get(metric.name, '')}")
+				lines.append(f"# TYPE {metric.name} {metric.kind}")
+
+			lines += metric.prometheus()
+
+		return '\n'.join(lines) + '\n'
+
+	def dump(self, path=None, format=None):
+		"""
+		Writes the current metrics to `path` (default --metrics-file).
+		The Prometheus format replaces the file, so it can be picked up by a textfile collector,
+		the JSON lines format appends a timestamped snapshot to it.
+		Each --shard writes to a file of its own (ex. metrics.shard-1-of-4.prom).
+		"""
+		if path is None:
+			path = storage['arguments'].metrics_file
+		if format is None:
+			format = storage['arguments'].metrics_format
+
+		# The filters import this module to count rejections, so this import has to wait until here
+		from .filters import shard_suffix
+
+		path = pathlib.Path(path)
+		path = path.with_name(f"{path.stem}{shard_suffix()}{path.suffix}")
+		path.parent.mkdir(parents=True, exist_ok=True)
+
+		if format == 'jsonl':
+			with open(path, 'a') as fh:
+				fh.write(json.dumps({'timestamp': time.time(), 'metrics': self.snapshot()}) + '\n')
+		else:
+			temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+			with open(temporary, 'w') as fh:
+				fh.write(self.prometheus())
+
+			os.replace(temporary, path)
+
+	def start(self, interval=None):
+		"""
+		Dumps the metrics every `interval` (default --metrics-interval) seconds on a background thread.
+		"""
+		if interval is None:
+			interval = storage['arguments'].metrics_interval
+
+		def run():
+			while not self.stopping.wait(interval):
+				try:
+					self.dump()
+				except OSError as err:
+					log(f"Could not write metrics to {storage['arguments'].metrics_file}: {err}", level=logging.WARNING, fg="orange")
+
+		self.stopping.clear()
+		self.thread = threading.Thread(target=run, name='pypiapi-metrics', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		"""
+		Stops the background thread and writes the final metrics.
+		"""
+		self.stopping.set()
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+		self.dump()
+
+
+_metrics_lock = threading.Lock()
+
+def metrics() -> Metrics:
+	"""
+	Returns the shared Metrics registry, creating it on first use.
+	"""
+	with _metrics_lock:
+		if 'metrics' not in storage:
+			storage['metrics'] = Metrics()
+
+		return storage['metrics']
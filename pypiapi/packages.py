@@ -1,44 +1,68 @@
 import re
-import copy
-import socket
-import ssl
-import json
+import functools
+import hashlib
+import http.client
 import logging
 import pathlib
 import urllib.error
-import urllib.request
-import hashlib
-import time
-from typing import List
-from distutils.version import LooseVersion
-from packaging.version import Version, parse as VersionParser, InvalidVersion
-from packaging.specifiers import SpecifierSet, InvalidSpecifier
+import os
+from typing import Dict, Iterable, List, Tuple
 
 from .storage import storage
-from .sockethelpers import epoll, EPOLLIN, EPOLLHUP
 from .logger import log
 from .licenses import licence_classifier_parser
-from .exceptions import VersionError, DependencyError, YankedPackage, InvalidPackage
-
-if storage['arguments'].proxy_host:
-	opener = urllib.request.build_opener(
-		urllib.request.ProxyHandler({storage['arguments'].proxy_protocol : f"{storage['arguments'].proxy_protocol}://{storage['arguments'].proxy_host}:{storage['arguments'].proxy_port}"})
-	)
-	urllib.request.install_opener(opener)
-	log(f"Added --proxy to all urllib.request", level=logging.INFO, fg="orange")
+from .artifacts import artifact_index
+from .blobs import blob_store
+from .metadata import metadata_cache
+from .connections import connection_pool
+from .scheduler import request_scheduler
+from .filters import filter_pipeline, supports_python
+from .metrics import metrics
+from .exceptions import VersionError, YankedPackage, InvalidPackage, IntegrityError
+
+# Downloads are streamed to disk in pieces of this size,
+# so memory usage stays the same regardless of the file size.
+CHUNK_SIZE = 256 * 1024
+
+# Versions that aren't strictly <number>.<number>...-<number> (used with LooseVersion)
+UNCLEAN_VERSION = re.compile(r'[^0-9.\-]')
 
 def safe_version(version):
 	# This is escalating..
 	return version.replace('>', '').replace('<', '').replace('=', '').replace('~', '').strip()
 
+@functools.lru_cache(maxsize=4096)
+def compile_python_requirement(sort_algorithm :str, requirement :str):
+	"""
+	Parses a requires_python string once per --sort-algorithm, as the same
+	handful of requirements (>=3.7 etc) are shared by most packages.
+	"""
+	if sort_algorithm == 'LooseVersion':
+		# distutils is slow to import (and gone in newer Pythons), so it's only imported when asked for
+		from distutils.version import LooseVersion
+		return LooseVersion(safe_version(requirement))
+	elif sort_algorithm == 'PackagingVersion':
+		from packaging.version import parse as VersionParser
+		return VersionParser(requirement)
+	elif sort_algorithm == 'SpecifierSet':
+		from packaging.specifiers import SpecifierSet
+		return SpecifierSet(requirement)
+
 class Package:
-	def __init__(self, name, cache=None):
+	# A sync can have many packages waiting in its queues, so they don't get a __dict__ each
+	__slots__ = ('_name', '_cache', '_sorted_versions', 'destination', 'serial')
+
+	def __init__(self, name, cache=None, serial=None):
 		if cache is None:
 			cache = {}
 
 		self._name = name
-		self.cache = cache
+		self._cache = cache
+		self._sorted_versions = None
 		self.destination = None
+		# The upstream serial of the last change to this package, if known.
+		# A locally cached copy older than this will be fetched again.
+		self.serial = serial
 
 	def __repr__(self):
 		return f"Package(name={self.name}, version={self.cache.get('info', {}).get('version', None)})"
@@ -46,6 +70,35 @@ class Package:
 	@property
 	def name(self):
 		return self._name
+
+	@property
+	def cache(self):
+		return self._cache
+
+	@cache.setter
+	def cache(self, value):
+		self._cache = value
+		self.invalidate()
+
+	def retain(self, versions :Iterable[str]):
+		"""
+		Drops the releases of every version but `versions` from the cache, once the selection is made.
+		The cache is replaced rather than modified, as the document may be shared with the metadata cache.
+		"""
+		if not self._cache:
+			return
+
+		releases = self._cache.get('releases', {})
+		self.cache = {
+			**self._cache,
+			'releases': {version: releases[version] for version in versions if version in releases}
+		}
+
+	def invalidate(self):
+		"""
+		Drops everything derived from the cache, call this after modifying the cache in place.
+		"""
+		self._sorted_versions = None
 	
 	@property
 	def information(self):
@@ -57,12 +110,7 @@ class Package:
 	@property
 	def python_version(self):
 		if required_python_version := self.information.get('info', {}).get('requires_python', None):
-			if storage['arguments'].sort_algorithm == 'LooseVersion':
-				return LooseVersion(safe_version(required_python_version))
-			elif storage['arguments'].sort_algorithm == 'PackagingVersion':
-				return VersionParser(required_python_version)
-			elif storage['arguments'].sort_algorithm == 'SpecifierSet':
-				return SpecifierSet(required_python_version)
+			return compile_python_requirement(storage['arguments'].sort_algorithm, required_python_version)
 
 		if storage['arguments'].skip_unknown_py_versions is True:
 			raise VersionError(f"Package {self} does not have a python version requirement.")
@@ -78,25 +126,10 @@ class Package:
 	def load_information(self):
 		self.set_destination()
 
-		if not self.cache and self.destination.exists() is False:
-			log(f"Sending request to https://{storage['arguments'].mirror}{storage['arguments'].json_api}/{self._name}/json", level=logging.DEBUG)
-			try:
-				request = urllib.request.urlopen(urllib.request.Request(f"https://{storage['arguments'].mirror}{storage['arguments'].json_api}/{self._name}/json", headers={'User-Agent': f"python-pypiapi-{storage['version']}"}))
-			except urllib.error.HTTPError as error:
-				log(f"Invalid package URL was detected, cannot return inforamtion for {self.name}: {error}", level=logging.ERROR, fg="orange")
-				raise InvalidPackage(f"Package URL returned an error '{error.status}' for package: {self.name}")
-			self.cache = json.loads(request.read().decode('UTF-8'))
-		
-		elif self.destination and (self.destination/f"{self._name}.json").exists() and not self.cache:
-			with open(f"{self.destination/self._name}.json", "r") as fh:
-				self.cache = json.load(fh)
-		
-		elif self.destination and self.cache:
-			if self.destination.exists() is False:
-				self.destination.mkdir(parents=True, exist_ok=True)
-
-			with open(f"{self.destination/self._name}.json", "w") as fh:
-				json.dump(self.cache, fh)
+		if not self.cache:
+			self.cache = metadata_cache().get(self)
+		else:
+			metadata_cache().put(self, self.cache)
 
 	def set_destination(self, destination=None):
 		if not destination:
@@ -112,57 +145,86 @@ class Package:
 
 		# Remove any verions that isn't strictly the format <number>.<number>...-<number>
 		for version in versions:
-			if any(re.findall(r'[^0-9.\-]', version)) is False:
+			if UNCLEAN_VERSION.search(version) is None:
 				clean.append(version)
 
 		return clean
 
-	def versions(self, limit=None):
-		if not limit and storage['arguments'].retain_versions:
-			limit = int(storage['arguments'].retain_versions)
+	def sorted_versions(self) -> List[str]:
+		"""
+		Returns all release versions, newest first, according to --sort-algorithm.
+		The result is kept until the cache changes (see invalidate()).
+		"""
+		if self._sorted_versions and self._sorted_versions[0] == storage['arguments'].sort_algorithm:
+			return self._sorted_versions[1]
 
 		try:
 			versions = list(self.information.get('releases', {}).keys())
 		except InvalidPackage:
 			return []
 
-		if not versions:
-				return []
+		from packaging.version import Version, parse as VersionParser, InvalidVersion
 
 		if storage['arguments'].sort_algorithm == 'LooseVersion':
+			from distutils.version import LooseVersion
+
 			versions = self.clean_versions(versions)
 			try:
 				versions.sort(key=LooseVersion)
 			except TypeError:
 				log(f"Version contains illegal characters: {versions}")
-				return []
+				versions = []
 		elif storage['arguments'].sort_algorithm == 'PackagingVersion':
 			try:
 				versions.sort(key=VersionParser)
 			except TypeError:
 				log(f"Version contains illegal characters: {versions}")
-				return []
+				versions = []
 		elif storage['arguments'].sort_algorithm == 'SpecifierSet':
 			try:
 				versions.sort(key=Version)
 			except TypeError:
 				log(f"Version contains illegal characters: {versions}")
-				return []
+				versions = []
 			except InvalidVersion:
 				log(f"Version contains illegal characters: {versions}")
-				return []
+				versions = []
 		else:
 			log(f"Unknown sorting algorithm: {storage['arguments'].sort_algorithm}", level=logging.ERROR, fg="red")
 			exit(1)
 
 		versions.reverse()
 
+		self._sorted_versions = (storage['arguments'].sort_algorithm, versions)
+		return versions
+
+	def versions(self, limit=None):
+		if not limit and storage['arguments'].retain_versions:
+			limit = int(storage['arguments'].retain_versions)
+
+		versions = self.sorted_versions()
+
+		if not versions:
+				return []
+
 		if limit and self.version not in versions[:limit]:
-			versions.insert(0, self.version)
+			return [self.version] + versions[:limit - 1]
 
 		return versions[:limit]
 
-	def download(self, version, destination=None, threaded=False, force=False) -> bool:
+	def files(self, version, destination=None, force=False) -> List[dict]:
+		"""
+		Returns the release files of a given version that should be downloaded,
+		after the license, python version and architecture filters have been applied.
+		Files already present on disk with a matching digest are left out.
+		"""
+		return self.prepare(version, destination=destination, force=force)[0]
+
+	def prepare(self, version, destination=None, force=False) -> Tuple[List[dict], bool]:
+		"""
+		Like files(), but also returns whether any file was put in place without being downloaded
+		(linked from, or moved into, the --blob-store), which the simple index has to know about.
+		"""
 		self.set_destination(destination)
 
 		if not version in list(self.information.get('releases', {}).keys()):
@@ -170,30 +232,7 @@ class Package:
 
 
 		if force is False:
-			if storage['arguments'].licenses and any([license in self.license for license in storage['arguments'].licenses]) is False:
-				raise DependencyError(f"Package {self.name}'s license {self.license} does not meet the license requirements: {storage['arguments'].licenses}")
-
-			try:
-				if storage['arguments'].sort_algorithm == 'SpecifierSet':
-					if self.python_version and storage['arguments'].py_version and self.python_version.contains(storage['arguments'].py_version) is False:
-						raise DependencyError(f"Package {self.name}'s Python versioning {self.python_version} does not meet the Python version requirements: {storage['arguments'].py_version}")
-				else:
-					if storage['arguments'].sort_algorithm == 'LooseVersion':
-						SelectedVersionHandler = LooseVersion
-					elif storage['arguments'].sort_algorithm == 'PackagingVersion':
-						SelectedVersionHandler = VersionParser
-					if self.python_version and storage['arguments'].py_versions and any([self.python_version >= SelectedVersionHandler(version) for version in storage['arguments'].py_versions]) is False:
-						raise DependencyError(f"Package {self.name}'s Python versioning {self.python_version} does not meet the Python version requirements: {storage['arguments'].py_version}")
-			except TypeError:
-				raise DependencyError(f"Package {self.name}'s Python versioning {self.python_version} does not meet the Python version requirements: {storage['arguments'].py_version}")
-			except InvalidSpecifier:
-				raise DependencyError(f"Package {self.name}'s Python versioning {self.python_version} does not meet the Python version requirements: {storage['arguments'].py_version}")
-			
-			except AttributeError as error:
-				print(error)
-				print(version)
-				print(self.cache)
-				exit(1)
+			filter_pipeline().check_package(self)
 
 		if not self.destination.exists():
 			try:
@@ -201,50 +240,185 @@ class Package:
 			except:
 				raise PermissionError(f"Could not create destination directory '{self.destination}' for package: {self.name}")
 
-		initated_output = False
+		artifacts = artifact_index(self.destination.parent)
+		blobs = blob_store(self.destination.parent) if storage['arguments'].blob_store else None
+		pipeline = filter_pipeline()
+
+		files = []
+		changed = False
 		for file in self.information['releases'][version]:
-			target_architecture = False
-			
-			if file.get('python_version', None) == 'source':
-				# We always accept the source code, as it can be compiled anywhere.
-				target_architecture = True
-			if file['filename'] == f"{self.name}-{version}.tar.gz":
-				# We cannot reliably say that a straight up .tar.gz is NOT
-				# the supported architecture and we'll have to include it.
-				target_architecture = True
-			else:
-				for arch in storage['arguments'].architectures:
-					if f"{arch.lower()}." in file['filename'].lower():
-						target_architecture = True
-						break
+			if not pipeline.accept_file(self, version, file, force=force):
+				continue
 
-			if not target_architecture:
-				log(f"  {file['filename']} not in target architectures: {storage['arguments'].architectures}", level=logging.DEBUG, fg="orange")
+			target = self.destination/file['filename']
+			digest = file.get('digests', {}).get('sha256', None)
+
+			if artifacts.verified(target, file.get('digests', {})):
+				log(f"  {file['filename']} (previously verified)", level=logging.DEBUG)
+			elif target.exists():
+				if not (algorithm := artifacts.check(target, file.get('digests', {}))):
+					files.append(file)
+					continue
+
+				log(f"  {file['filename']} ({algorithm} matched)", level=logging.DEBUG)
+			elif blobs and digest and blobs.exists(digest):
+				# The same content was already downloaded, possibly by another package
+				blobs.link(digest, target)
+				artifacts.add(target, digest)
+				changed = True
+				log(f"  {file['filename']} (linked from the blob store)", level=logging.DEBUG)
+			else:
+				files.append(file)
 				continue
 
-			if (self.destination/file['filename']).exists():
-				with open(self.destination/file['filename'], 'rb') as fh:
-					if hashlib.sha256(fh.read()).hexdigest() == file.get('digests', {}).get('sha256', None):
-						log(f"  {file['filename']} (sha256 matched)", level=logging.DEBUG)
-						continue
-					elif hashlib.md5(fh.read()).hexdigest() == file.get('digests', {}).get('md5', None):
-						log(f"  {file['filename']} (md5 matched)", level=logging.DEBUG)
-						continue
+			# Files from before the blob store was enabled are moved into it as they're encountered
+			if blobs and digest and blobs.adopt(target, digest):
+				artifacts.add(target, digest)
+				changed = True
+
+			metrics().counter('pypiapi_files_present_total', "Selected files that were already on disk").inc()
+
+		return files, changed
+
+	def download_file(self, file) -> int:
+		"""
+		Downloads a single release file (as returned by files()) into the package destination.
+		The response is streamed to <filename>.part in CHUNK_SIZE pieces while being hashed,
+		and only renamed into place once the digest matches file['digests'].
+		If a .part file was left behind by an interrupted run, the transfer is resumed
+		from where it stopped with a Range request. Transfers that time out or break off
+		are retried the same way (see RequestScheduler).
+		Returns the number of bytes transferred.
+		"""
+		return request_scheduler().retrying(lambda: self._download_file(file), file['url'])
+
+	def _download_file(self, file) -> int:
+		log(f"  Downloading: {file['filename']}", level=logging.INFO)
+		log(f"  Sending request to {file['url']}", level=logging.DEBUG)
+
+		target = self.destination/file['filename']
+		# The partial file lives next to the target so that the final rename is atomic.
+		partial = self.destination/f"{file['filename']}.part"
+
+		digests = file.get('digests', {})
+		if digests.get('sha256', None):
+			algorithm, expected = 'sha256', digests['sha256']
+		elif digests.get('md5', None):
+			algorithm, expected = 'md5', digests['md5']
+		else:
+			algorithm, expected = 'sha256', None
+
+		checksum = hashlib.new(algorithm)
+		offset = 0
+		size = 0
 
-			log(f"  Downloading: {file['filename']}", level=logging.INFO)
-			log(f"  Sending request to {file['url']}", level=logging.DEBUG)
+		headers = {}
+		if partial.exists() and (offset := partial.stat().st_size):
+			log(f"  Resuming {file['filename']} from byte {offset}", level=logging.DEBUG)
+			headers['Range'] = f"bytes={offset}-"
 
-			if initated_output is False:
-				log(f"Initating download of {self}@version: {version}", fg="yellow", level=logging.INFO)
-				initated_output = True
-				
-			request = urllib.request.urlopen(urllib.request.Request(file['url'], headers={'User-Agent': f"python-pypiapi-{storage['version']}"}))
+		try:
+			request = connection_pool().urlopen(file['url'], headers=headers)
+		except urllib.error.HTTPError as error:
+			if error.code != 416:
+				raise
+
+			# The .part file is already as long as (or longer than) the file upstream,
+			# which means it can't be resumed and has to be downloaded again.
+			request = None
+
+		if request is None or request.status != 206:
+			if offset:
+				log(f"  {file['filename']} could not be resumed, downloading it from the start", level=logging.DEBUG)
+			offset = 0
+
+		if offset:
+			with open(partial, 'rb') as fh:
+				while chunk := fh.read(CHUNK_SIZE):
+					checksum.update(chunk)
+		elif request is None:
+			partial.unlink(missing_ok=True)
+			request = connection_pool().urlopen(file['url'])
+
+		downloaded = metrics().counter('pypiapi_downloaded_bytes_total', "Bytes of release files received")
+
+		try:
+			with request, open(partial, "ab" if offset else "wb") as version_fh:
+				while chunk := request.read(CHUNK_SIZE):
+					checksum.update(chunk)
+					version_fh.write(chunk)
+					size += len(chunk)
+					downloaded.inc(len(chunk))
+
+			if (length := request.headers.get('Content-Length', None)) and size < int(length):
+				# The connection was closed early, what did arrive is kept in the .part file and resumed on retry
+				raise http.client.IncompleteRead(b'', int(length) - size)
+
+			if expected and checksum.hexdigest() != expected:
+				raise IntegrityError(f"Downloaded file {file['filename']} has {algorithm} {checksum.hexdigest()}, expected {expected}")
+		except IntegrityError:
+			partial.unlink(missing_ok=True)
+			raise
+
+		if storage['arguments'].blob_store and algorithm == 'sha256' and expected:
+			blobs = blob_store(self.destination.parent)
+			blobs.add(partial, expected)
+			blobs.link(expected, target)
+		else:
+			os.replace(partial, target)
 
+		metrics().counter('pypiapi_downloaded_files_total', "Release files downloaded and verified").inc()
+		if expected:
+			artifact_index(self.destination.parent).add(target, expected, algorithm)
+
+		return size
+
+	def download(self, version, destination=None, threaded=False, force=False) -> bool:
+		files = self.files(version, destination=destination, force=force)
+
+		if files:
+			log(f"Initating download of {self}@version: {version}", fg="yellow", level=logging.INFO)
+
+		# Failures that are still there after --max-retries (see RequestScheduler.transient()) are logged and skipped
+		for file in files:
 			try:
-				with open(self.destination/file['filename'], "wb") as version_fh:
-					version_fh.write(request.read())
-			except urllib.error.URLError as err:
-				(self.destination/file['filename']).unlink()
+				self.download_file(file)
+			except (urllib.error.URLError, OSError, http.client.HTTPException, IntegrityError) as err:
 				log(f"Could not download {file['filename']} due to: {err}", level=logging.ERROR, fg="red")
+				metrics().counter('pypiapi_download_failures_total', "Release files that could not be downloaded").inc()
+
+		return True
+
+def select_versions(packages :Iterable[Package], limit=None, py_version=None) -> Dict[Package, List[str]]:
+	"""
+	Picks the newest `limit` (default --retain-versions) versions of many packages in one pass,
+	only counting versions where at least one file supports `py_version` (default --py-version).
+	The requires_python of each file is evaluated once per distinct requirement string.
+	"""
+	if not limit and storage['arguments'].retain_versions:
+		limit = int(storage['arguments'].retain_versions)
+	if py_version is None:
+		py_version = storage['arguments'].py_version
+
+	selection = {}
+	for package in packages:
+		selected = []
+
+		try:
+			releases = package.information.get('releases', {})
+		except InvalidPackage:
+			selection[package] = selected
+			continue
+
+		for version in package.sorted_versions():
+			for file in releases.get(version, []):
+				if not py_version or not (requirement := file.get('requires_python', None)) or supports_python(requirement, py_version):
+					selected.append(version)
+					break
+
+			if limit and len(selected) == limit:
+				break
+
+		selection[package] = selected
 
-		return True
\ No newline at end of file
+	return selection
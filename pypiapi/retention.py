@@ -0,0 +1,163 @@
+import logging
+import os
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Set, Tuple
+
+from .storage import storage
+from .logger import log
+from .packages import Package
+from .artifacts import artifact_index
+from .blobs import blob_store
+from .metadata import metadata_store
+from .filters import filter_pipeline
+from .downloader import human_bytes
+from .metrics import metrics
+from .simpleindex import simple_index
+
+class GarbageCollector:
+	"""
+	Removes files from --destination that a sync would no longer select:
+	releases outside of --retain-versions, files the architecture and python filters reject,
+	stale .part files and <name>.json files already moved into the metadata store.
+	Only the stored package information is used, so nothing is requested upstream,
+	and packages without stored information are left alone.
+	With --blob-store, blobs no longer referenced by any package are removed as well,
+	and with --simple-index the pages of packages that lost files are rewritten.
+	"""
+	def __init__(self, destination=None, dry_run=None, workers=None):
+		if not destination:
+			destination = storage['arguments'].destination
+		if dry_run is None:
+			dry_run = storage['arguments'].dry_run
+		if not workers:
+			workers = os.cpu_count() or 1
+
+		self.root = pathlib.Path(destination)
+		self.dry_run = dry_run
+		self.workers = workers
+		self.lock = threading.Lock()
+		self.referenced: Set[str] = set()
+		self.files_removed = 0
+		self.bytes_removed = 0
+
+	def remove(self, path :pathlib.Path, reason :str):
+		size = path.lstat().st_size
+
+		if self.dry_run:
+			log(f"  Would remove {path.relative_to(self.root)} ({reason})", level=logging.INFO, fg="gray")
+		else:
+			log(f"  Removing {path.relative_to(self.root)} ({reason})", level=logging.DEBUG)
+			path.unlink()
+			artifact_index(self.root).remove(path)
+			metrics().counter('pypiapi_gc_removed_files_total', "Files removed by the garbage collection").inc()
+			metrics().counter('pypiapi_gc_removed_bytes_total', "Bytes removed by the garbage collection").inc(size)
+
+		with self.lock:
+			self.files_removed += 1
+			self.bytes_removed += size
+
+	def retained(self, package :Package) -> Set[str]:
+		"""
+		Returns the filenames a sync would keep for a package, recording their digests as referenced.
+		"""
+		pipeline = filter_pipeline()
+		releases = package.information.get('releases', {})
+
+		keep = set()
+		digests = set()
+		for version in package.versions():
+			for file in releases.get(version, []):
+				if pipeline.accept_file(package, version, file):
+					keep.add(file['filename'])
+					if digest := file.get('digests', {}).get('sha256', None):
+						digests.add(digest)
+
+		with self.lock:
+			self.referenced |= digests
+
+		return keep
+
+	def collect_package(self, name :str):
+		document, _, _ = metadata_store(self.root).get(name)
+		if not document:
+			log(f"  Leaving {name} alone, there is no stored information about it", level=logging.DEBUG)
+
+			# Its files may still be symlinks into the blob store, which have to stay
+			with os.scandir(self.root/name) as entries:
+				links = {os.path.basename(os.readlink(entry.path)) for entry in entries if entry.is_symlink()}
+			with self.lock:
+				self.referenced |= links
+			return
+
+		package = Package(name, cache=document)
+		package.set_destination(self.root)
+		keep = self.retained(package)
+
+		removed = 0
+		remaining = 0
+		with os.scandir(package.destination) as entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					remaining += 1
+				elif entry.name in keep:
+					remaining += 1
+				elif entry.name in (f"{name}.json", f"{name}.json.headers"):
+					self.remove(pathlib.Path(entry.path), "moved to the metadata store")
+					removed += 1
+				elif entry.name.endswith('.part') and entry.name[:-5] in keep:
+					# An interrupted download the next sync will resume
+					remaining += 1
+				else:
+					self.remove(pathlib.Path(entry.path), "not retained")
+					removed += 1
+
+		if not remaining and not self.dry_run:
+			package.destination.rmdir()
+
+		if storage['arguments'].simple_index and not self.dry_run and removed:
+			simple_index(self.root).update(package)
+
+	def collect_blobs(self):
+		blobs = blob_store(self.root)
+		if not blobs.root.exists():
+			return
+
+		for directory, _, filenames in os.walk(blobs.root):
+			for filename in filenames:
+				path = pathlib.Path(directory)/filename
+				# Hardlinked blobs that are still linked from a package directory have more than one link
+				if filename not in self.referenced and path.lstat().st_nlink == 1:
+					self.remove(path, "no longer referenced")
+
+	def run(self) -> Tuple[int, int]:
+		"""
+		Collects all package directories in paralell, returning the number of files and bytes removed.
+		"""
+		pipeline = filter_pipeline()
+		names = [
+			entry.name for entry in os.scandir(self.root)
+			if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.') and pipeline.accept_name(entry.name)
+		]
+
+		def collect(name):
+			try:
+				self.collect_package(name)
+			except OSError as err:
+				log(f"Could not collect garbage of {name}: {err}", level=logging.ERROR, fg="red")
+
+		with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pypiapi-gc') as executor:
+			for _ in executor.map(collect, names):
+				pass
+
+		# A blob can only be known to be unused once every package has been looked at
+		if storage['arguments'].packages or storage['arguments'].shard:
+			log(f"Not removing unreferenced blobs, as only some packages were collected (--packages or --shard)", level=logging.DEBUG)
+		else:
+			self.collect_blobs()
+
+		verb = 'Would remove' if self.dry_run else 'Removed'
+		log(f"{verb} {self.files_removed} files ({human_bytes(self.bytes_removed)}) from {len(names)} packages", level=logging.INFO, fg="green")
+
+		return self.files_removed, self.bytes_removed
@@ -0,0 +1,226 @@
+import email.utils
+import http.client
+import logging
+import random
+import threading
+import time
+import urllib.error
+from typing import Callable, Dict, Optional, TypeVar
+
+from .storage import storage
+from .logger import log
+from .metrics import metrics
+
+T = TypeVar('T')
+
+# Responses that are worth asking again for, anything else is final
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Responses where the host tells us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+# Upper bound of the exponential backoff, and of how long a Retry-After is honored, in seconds
+MAX_BACKOFF = 60
+MAX_RETRY_AFTER = 300
+
+def retry_after(headers) -> Optional[float]:
+	"""
+	Returns the seconds to wait according to a Retry-After header (delay-seconds or an HTTP-date), if there is one.
+	"""
+	if headers is None or not (value := headers.get('Retry-After', None)):
+		return None
+
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		pass
+
+	try:
+		return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
+
+class TokenBucket:
+	"""
+	Hands out `rate` tokens per second, allowing bursts of up to `burst`. A rate of 0 never waits.
+	"""
+	def __init__(self, rate :float, burst :Optional[float] = None):
+		self.rate = rate
+		self.burst = burst or max(1.0, rate)
+		self.tokens = self.burst
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def take(self):
+		if not self.rate:
+			return
+
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+
+				wait = (1 - self.tokens) / self.rate
+
+			time.sleep(wait)
+
+class HostLimiter:
+	"""
+	Decides when a request to a single host may be sent: not while a Retry-After is pending,
+	not faster than --rate-limit, and not with more than `limit` requests waiting for a response.
+	The limit adapts (AIMD): it grows by one for every `limit` responses that arrive about as fast
+	as the fastest ones seen, stays put while responses are slow (the host is queueing them),
+	and is halved when the host throttles (429/503) or fails to answer.
+	"""
+	def __init__(self, host :str, rate :float, maximum :int, initial :int = 8):
+		self.host = host
+		self.bucket = TokenBucket(rate)
+		self.maximum = max(1, maximum)
+		self.limit = float(max(1, min(initial, self.maximum)))
+		self.active = 0
+		self.paused_until = 0.0
+		self.baseline = None
+		self.last_decrease = 0.0
+		self.condition = threading.Condition()
+
+	def acquire(self):
+		with self.condition:
+			while True:
+				now = time.monotonic()
+				if self.paused_until > now:
+					self.condition.wait(self.paused_until - now)
+				elif self.active >= int(self.limit):
+					self.condition.wait()
+				else:
+					break
+
+			self.active += 1
+
+		self.bucket.take()
+
+	def release(self, latency :Optional[float] = None, throttled :bool = False, pause :Optional[float] = None):
+		"""
+		Gives back the slot of a request, with the time until its response arrived if it did.
+		Throttled requests (including timeouts and dropped connections) lower the limit.
+		"""
+		with self.condition:
+			self.active -= 1
+
+			if pause:
+				self.paused_until = max(self.paused_until, time.monotonic() + min(pause, MAX_RETRY_AFTER))
+
+			if throttled:
+				self.decrease()
+			elif latency is not None:
+				self.observe(latency)
+
+			self.condition.notify_all()
+
+	def observe(self, latency :float):
+		# The baseline is the fastest recent response, slowly drifting up so a host that got slower for good is re-learned
+		if self.baseline is None or latency < self.baseline:
+			self.baseline = latency
+		else:
+			self.baseline += (latency - self.baseline) * 0.01
+
+		if latency <= self.baseline * 2 + 0.05 and self.limit < self.maximum:
+			self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+	def decrease(self):
+		now = time.monotonic()
+		# Requests that were already in flight when the host pushed back shouldn't halve the limit again
+		if now - self.last_decrease < 1:
+			return
+
+		self.last_decrease = now
+		self.limit = max(1.0, self.limit / 2)
+		log(f"Lowering the concurrent requests to {self.host} to {int(self.limit)}", level=logging.DEBUG)
+
+class RequestScheduler:
+	"""
+	Paces and retries the requests sent upstream. Each host gets a HostLimiter, and transient failures
+	(timeouts, dropped connections, 429 and 5xx responses) are retried up to --max-retries times,
+	waiting --retry-backoff * 2^attempt seconds with full jitter, or as long as Retry-After says.
+	"""
+	def __init__(self, rate=None, retries=None, backoff=None, concurrency=None):
+		if rate is None:
+			rate = storage['arguments'].rate_limit
+		if retries is None:
+			retries = storage['arguments'].max_retries
+		if backoff is None:
+			backoff = storage['arguments'].retry_backoff
+		if concurrency is None:
+			concurrency = storage['arguments'].max_host_concurrency
+
+		self.rate = rate
+		self.retries = retries
+		self.backoff = backoff
+		self.concurrency = concurrency
+		self.lock = threading.Lock()
+		self.hosts: Dict[str, HostLimiter] = {}
+		self.local = threading.local()
+
+	def host(self, host :str) -> HostLimiter:
+		with self.lock:
+			if host not in self.hosts:
+				self.hosts[host] = HostLimiter(host, self.rate, self.concurrency)
+
+			return self.hosts[host]
+
+	def delay(self, attempt :int, after :Optional[float] = None) -> float:
+		if after is not None:
+			return min(after, MAX_RETRY_AFTER)
+
+		return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+	def transient(self, error :BaseException) -> bool:
+		if isinstance(error, urllib.error.HTTPError):
+			return error.code in RETRY_STATUSES
+
+		return isinstance(error, (TimeoutError, ConnectionError, http.client.HTTPException))
+
+	def retrying(self, function :Callable[[], T], description :str) -> T:
+		"""
+		Calls function, calling it again after a backoff for as long as it fails transiently and there are retries left.
+		Requests made inside function leave the retrying to the outermost call, so a failure
+		while reading a response retries the request as well without retrying it twice.
+		"""
+		if getattr(self.local, 'retrying', False):
+			return function()
+
+		self.local.retrying = True
+		try:
+			attempt = 0
+			while True:
+				try:
+					return function()
+				except Exception as error:
+					if attempt >= self.retries or not self.transient(error):
+						raise
+
+					wait = self.delay(attempt, retry_after(getattr(error, 'headers', None)))
+					reason = f"status {error.code}" if isinstance(error, urllib.error.HTTPError) else type(error).__name__
+					metrics().counter('pypiapi_request_retries_total', "Requests sent again after a transient failure", reason=reason).inc()
+					log(f"Retrying {description} in {wait:.1f} seconds after {reason} ({error}), attempt {attempt + 1} of {self.retries}", level=logging.WARNING, fg="orange")
+
+					time.sleep(wait)
+					attempt += 1
+		finally:
+			self.local.retrying = False
+
+
+_scheduler_lock = threading.Lock()
+
+def request_scheduler() -> RequestScheduler:
+	"""
+	Returns the shared RequestScheduler, creating it on first use.
+	"""
+	with _scheduler_lock:
+		if 'request_scheduler' not in storage:
+			storage['request_scheduler'] = RequestScheduler()
+
+		return storage['request_scheduler']
@@ -0,0 +1,187 @@
+import functools
+import html
+import logging
+import os
+import pathlib
+import posixpath
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from .storage import storage
+from .logger import log
+from .metadata import metadata_store
+from .packages import Package
+
+PAGE = """<!DOCTYPE html>
+<html>
+	<head>
+		<meta name="pypi:repository-version" content="1.0">
+		<title>{title}</title>
+	</head>
+	<body>
+		<h1>{title}</h1>
+{links}
+	</body>
+</html>
+"""
+
+class SimpleIndex:
+	"""
+	A static PEP 503 simple index of the files in --destination, under <destination>/.simple/.
+	Each package gets .simple/<normalized name>/index.html, linking to its files with their sha256,
+	and is only rewritten when the package changed. Serve --destination with /simple/ pointing
+	at .simple/ (see serve()) and use it with pip install --index-url http://<host>/simple/.
+	"""
+	def __init__(self, destination=None):
+		if not destination:
+			destination = storage['arguments'].destination
+
+		self.destination = pathlib.Path(destination)
+		self.root = self.destination/'.simple'
+		self.lock = threading.Lock()
+		self.added = False
+
+	def page(self, package) -> pathlib.Path:
+		from packaging.utils import canonicalize_name
+
+		return self.root/canonicalize_name(package.name)/'index.html'
+
+	def exists(self, package) -> bool:
+		return self.page(package).exists()
+
+	def _write(self, path :pathlib.Path, content :str):
+		path.parent.mkdir(parents=True, exist_ok=True)
+		temporary = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+		with open(temporary, 'w') as fh:
+			fh.write(content)
+
+		os.replace(temporary, path)
+
+	def update(self, package):
+		"""
+		Rewrites the page of a package from its information and the files it has on disk.
+		"""
+		directory = self.destination/package.name
+		try:
+			with os.scandir(directory) as entries:
+				present = {entry.name for entry in entries if not entry.name.endswith('.part')}
+		except FileNotFoundError:
+			present = set()
+
+		links = []
+		for version, files in package.information.get('releases', {}).items():
+			for file in files:
+				if file['filename'] not in present:
+					continue
+
+				href = f"../../{urllib.parse.quote(package.name)}/{urllib.parse.quote(file['filename'])}"
+				if digest := file.get('digests', {}).get('sha256', None):
+					href += f"#sha256={digest}"
+
+				attributes = ''
+				if requirement := file.get('requires_python', None):
+					attributes += f' data-requires-python="{html.escape(requirement)}"'
+				if file.get('yanked', False):
+					attributes += ' data-yanked=""'
+
+				links.append(f'\t\t<a href="{href}"{attributes}>{html.escape(file["filename"])}</a><br/>')
+
+		page = self.page(package)
+		if not page.exists():
+			if not links:
+				# Packages without any files on disk aren't worth listing
+				return
+
+			self.added = True
+
+		self._write(page, PAGE.format(title=f"Links for {html.escape(package.name)}", links='\n'.join(links)))
+		log(f"  Updated the simple index of {package.name}", level=logging.DEBUG)
+
+	def commit(self, force=False):
+		"""
+		Rewrites .simple/index.html, the list of all projects, if projects were added since the last commit.
+		"""
+		with self.lock:
+			if not self.added and not force and (self.root/'index.html').exists():
+				return
+
+			self.added = False
+
+		names = sorted(entry.name for entry in os.scandir(self.root) if entry.is_dir()) if self.root.exists() else []
+		links = '\n'.join(f'\t\t<a href="{urllib.parse.quote(name)}/">{html.escape(name)}</a><br/>' for name in names)
+
+		self._write(self.root/'index.html', PAGE.format(title="Simple index", links=links))
+		log(f"Wrote the simple index of {len(names)} projects to {self.root}", level=logging.INFO, fg="gray")
+
+	def rebuild(self):
+		"""
+		Writes the pages of every package in --destination that has stored information.
+		"""
+		store = metadata_store(self.destination)
+		for entry in os.scandir(self.destination):
+			if not entry.is_dir(follow_symlinks=False) or entry.name.startswith('.'):
+				continue
+
+			document, _, _ = store.get(entry.name)
+			if document:
+				self.update(Package(entry.name, cache=document))
+
+		self.commit(force=True)
+
+class IndexRequestHandler(SimpleHTTPRequestHandler):
+	"""
+	Serves --destination, with /simple/ mapped to the .simple/ directory.
+	Everything else starting with a dot (the metadata store, journals etc) is hidden.
+	"""
+	def translate_path(self, path):
+		path = urllib.parse.urlsplit(path).path
+		if path == '/simple' or path.startswith('/simple/'):
+			path = '/.simple' + path[len('/simple'):]
+
+		parts = [part for part in posixpath.normpath(urllib.parse.unquote(path)).split('/') if part]
+		if any(part.startswith('.') for part in parts[1:]) or (parts and parts[0].startswith('.') and parts[0] != '.simple'):
+			return os.path.join(self.directory, '.hidden-not-found')
+
+		return super().translate_path(path)
+
+	def log_message(self, format, *args):
+		log(f"{self.address_string()} {format % args}", level=logging.DEBUG)
+
+def serve(bind=None, port=None):
+	"""
+	Serves --destination over HTTP until interrupted, building the simple index first if there is none.
+	"""
+	if bind is None:
+		bind = storage['arguments'].bind
+	if port is None:
+		port = storage['arguments'].serve_port
+
+	index = simple_index()
+	if not (index.root/'index.html').exists():
+		log(f"There is no simple index in {index.destination} yet, building it", level=logging.INFO, fg="yellow")
+		index.rebuild()
+
+	handler = functools.partial(IndexRequestHandler, directory=str(index.destination))
+	with ThreadingHTTPServer((bind, port), handler) as server:
+		log(f"Serving {index.destination} on http://{bind}:{port}/simple/", level=logging.INFO, fg="green")
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+
+
+_index_lock = threading.Lock()
+
+def simple_index(destination=None) -> SimpleIndex:
+	"""
+	Returns the shared SimpleIndex for a destination, creating it on first use.
+	"""
+	destination = pathlib.Path(destination or storage['arguments'].destination)
+
+	with _index_lock:
+		indexes = storage.setdefault('simple_indexes', {})
+		if destination not in indexes:
+			indexes[destination] = SimpleIndex(destination)
+
+		return indexes[destination]
@@ -1,3 +1,14 @@
-storage = {
-	
-}
\ No newline at end of file
+class Storage(dict):
+	"""
+	The shared state of pypiapi. storage['arguments'] is filled in with the
+	configuration from sys.argv the first time it's used, unless configure() was called.
+	"""
+	def __missing__(self, key):
+		if key == 'arguments':
+			from .config import configure
+			return configure()
+
+		raise KeyError(key)
+
+
+storage = Storage()
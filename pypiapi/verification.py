@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .storage import storage
+from .logger import log
+from .packages import Package
+from .artifacts import artifact_index, hash_file
+from .metadata import metadata_store
+from .filters import filter_pipeline
+from .downloader import human_bytes
+from .exceptions import InvalidPackage
+
+class Verifier:
+	"""
+	Checks every file in --destination against the digests in the stored package information,
+	re-hashing all of them (in paralell, in chunks) instead of trusting the artifact index.
+	Files are reported as corrupt (the digest doesn't match), missing (a sync would select
+	them but they aren't on disk) or unexpected (not part of any release of the package).
+	Nothing is requested upstream and nothing is removed: corrupt files are dropped from the
+	artifact index, so the next sync downloads them again.
+	"""
+	def __init__(self, destination=None, workers=None):
+		if not destination:
+			destination = storage['arguments'].destination
+		if not workers:
+			workers = os.cpu_count() or 1
+
+		self.root = pathlib.Path(destination)
+		self.workers = workers
+		self.lock = threading.Lock()
+		self.corrupt: List[str] = []
+		self.missing: List[str] = []
+		self.unexpected: List[str] = []
+		self.files_verified = 0
+		self.bytes_verified = 0
+		self.last_report = time.time()
+
+	def plan(self, name :str) -> List[Tuple[pathlib.Path, str, str]]:
+		"""
+		Returns the (path, algorithm, digest) of every file of a package that is on disk,
+		recording the missing and unexpected ones along the way.
+		"""
+		with os.scandir(self.root/name) as entries:
+			present = {
+				entry.name for entry in entries
+				if not entry.is_dir(follow_symlinks=False) and not entry.name.endswith('.part')
+				and entry.name not in (f"{name}.json", f"{name}.json.headers")
+			}
+
+		document, _, _ = metadata_store(self.root).get(name)
+		if not document:
+			log(f"  {name} has no stored information, its files can't be verified", level=logging.DEBUG)
+			self.record('unexpected', [f"{name}/{filename}" for filename in sorted(present)])
+			return []
+
+		package = Package(name, cache=document)
+		package.set_destination(self.root)
+		releases = package.information.get('releases', {})
+		pipeline = filter_pipeline()
+
+		digests: Dict[str, dict] = {}
+		for files in releases.values():
+			for file in files:
+				digests[file['filename']] = file.get('digests', {})
+
+		missing = []
+		try:
+			for version in package.versions():
+				for file in releases.get(version, []):
+					if file['filename'] not in present and pipeline.accept_file(package, version, file):
+						missing.append(f"{name}/{file['filename']}")
+		except InvalidPackage:
+			pass
+
+		self.record('missing', missing)
+		self.record('unexpected', [f"{name}/{filename}" for filename in sorted(present) if filename not in digests])
+
+		tasks = []
+		for filename in sorted(present):
+			for algorithm in ('sha256', 'md5'):
+				if expected := digests.get(filename, {}).get(algorithm, None):
+					tasks.append((self.root/name/filename, algorithm, expected))
+					break
+
+		return tasks
+
+	def record(self, kind :str, relatives :List[str]):
+		if not relatives:
+			return
+
+		for relative in relatives:
+			log(f"  {relative} is {kind}", level=logging.WARNING, fg="orange")
+
+		with self.lock:
+			getattr(self, kind).extend(relatives)
+
+	def check(self, task :Tuple[pathlib.Path, str, str]):
+		path, algorithm, expected = task
+		artifacts = artifact_index(self.root)
+
+		try:
+			size = os.stat(path).st_size
+			valid = hash_file(path, algorithm) == expected
+		except OSError as err:
+			log(f"  Could not read {path.relative_to(self.root)}: {err}", level=logging.ERROR, fg="red")
+			size, valid = 0, False
+
+		if valid:
+			if not artifacts.verified(path, {algorithm: expected}):
+				artifacts.add(path, expected, algorithm)
+		else:
+			self.record('corrupt', [str(path.relative_to(self.root))])
+			artifacts.remove(path)
+
+		with self.lock:
+			self.files_verified += 1
+			self.bytes_verified += size
+
+			report = time.time() - self.last_report > 60
+			if report:
+				self.last_report = time.time()
+
+		if report:
+			log(f"Verified {self.files_verified} files ({human_bytes(self.bytes_verified)}) so far", level=logging.INFO, fg="gray")
+
+	def run(self, report :Optional[pathlib.Path] = None) -> bool:
+		"""
+		Verifies all package directories, writing the results as JSON to `report` if given.
+		Returns True if there were no corrupt or missing files.
+		"""
+		if not self.root.is_dir():
+			log(f"There is nothing to verify, {self.root} does not exist", level=logging.ERROR, fg="red")
+			return False
+
+		pipeline = filter_pipeline()
+		names = sorted(
+			entry.name for entry in os.scandir(self.root)
+			if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.') and pipeline.accept_name(entry.name)
+		)
+
+		started = time.time()
+		with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pypiapi-verify') as executor:
+			tasks = [task for tasks in executor.map(self.plan, names) for task in tasks]
+
+			# Each file is its own task, so a few very large files don't hold up a single worker
+			for _ in executor.map(self.check, tasks):
+				pass
+
+		elapsed = max(time.time() - started, 0.001)
+		log(f"Verified {self.files_verified} files ({human_bytes(self.bytes_verified)}, {human_bytes(self.bytes_verified / elapsed)}/s) of {len(names)} packages: "
+			f"{len(self.corrupt)} corrupt, {len(self.missing)} missing, {len(self.unexpected)} unexpected",
+			level=logging.INFO, fg="green" if not (self.corrupt or self.missing) else "orange")
+
+		if report:
+			with open(report, 'w') as fh:
+				json.dump({
+					'destination': str(self.root),
+					'verified': self.files_verified,
+					'bytes': self.bytes_verified,
+					'corrupt': sorted(self.corrupt),
+					'missing': sorted(self.missing),
+					'unexpected': sorted(self.unexpected),
+				}, fh, indent=4)
+
+		artifact_index(self.root).close()
+
+		return not (self.corrupt or self.missing)